@@ -0,0 +1,115 @@
+"""
+/find full-text search over a synthetic corpus.
+
+    python bench/bench_fts.py [messages] [clients]
+
+Builds a throwaway DB with `messages` (default 1M) conversation lines spread over
+tickets of `clients` (default 50k) clients, inserting through the FTS triggers
+(the same incremental path log_message/upsert_client use), then times
+bot.search_tickets for a mix of rare/common words, prefixes, surnames and phone
+fragments. Nothing touches doloni.db or Telegram.
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+WORDS_IT = (
+    "buongiorno salve grazie permesso soggiorno scaduto rinnovo questura appuntamento ricevuta "
+    "isee documenti famiglia figli assegno unico patente conversione traduzione medico visita "
+    "contratto affitto residenza codice fiscale iban inps domanda pagamento prezzo quando domani"
+).split()
+WORDS_UK = (
+    "привіт добрий день дякую потрібен документ довідка паспорт дитина сім'я оренда договір "
+    "права переклад лікар запис коли завтра ціна оплата заява допомога прописка"
+).split()
+SURNAMES = "Rossi Bianchi Ferrari Esposito Romano Colombo Ricci Marino Greco Bruno Шевченко Коваленко Бондаренко Ткаченко Кравченко Олійник".split()
+NAMES = "Mario Luca Giulia Anna Marco Sofia Олена Тарас Ірина Андрій Оксана Микола".split()
+
+
+def seed(path: str, n_messages: int, n_clients: int):
+    rnd = random.Random(42)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    now = "2026-01-01T00:00:00+00:00"
+
+    t0 = time.perf_counter()
+    conn.executemany(
+        "INSERT INTO clients (tg_id, phone, surname, name, lang, created_at) VALUES (?, ?, ?, ?, 'it', ?)",
+        ((i, f"39{rnd.randrange(10**9, 10**10)}", f"{rnd.choice(SURNAMES)}{i % 997}", rnd.choice(NAMES), now)
+         for i in range(1, n_clients + 1)),
+    )
+    n_tickets = n_clients * 2
+    conn.executemany(
+        "INSERT INTO tickets (ticket_id, client_tg_id, service, status, created_at, updated_at) VALUES (?, ?, 'ISEE', 'closed', ?, ?)",
+        ((bot.format_ticket_id(2026, i), 1 + i % n_clients, now, now) for i in range(1, n_tickets + 1)),
+    )
+    conn.commit()
+
+    def lines():
+        for i in range(n_messages):
+            words = WORDS_IT if i % 3 else WORDS_UK
+            text = " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 14)))
+            if i % 50_000 == 0:
+                text += " marmellata"  # rare word
+            yield bot.format_ticket_id(2026, 1 + i % n_tickets), "client" if i % 2 else "operator", text, now
+
+    batch = []
+    for row in lines():
+        batch.append(row)
+        if len(batch) == 50_000:
+            conn.executemany("INSERT INTO messages (ticket_id, from_role, text, created_at) VALUES (?, ?, ?, ?)", batch)
+            batch.clear()
+    if batch:
+        conn.executemany("INSERT INTO messages (ticket_id, from_role, text, created_at) VALUES (?, ?, ?, ?)", batch)
+    conn.commit()
+    took = time.perf_counter() - t0
+    conn.close()
+    print(f"seeded {n_clients:,} clients, {n_tickets:,} tickets, {n_messages:,} messages "
+          f"through FTS triggers in {took:.1f}s ({n_messages / took:,.0f} msg/s)")
+
+
+async def run(n_messages: int, n_clients: int):
+    path = os.path.join(tempfile.mkdtemp(prefix="doloni-bench-"), "bench.db")
+    bot.db_pool.path = path
+    await bot.db_pool.open()
+    await bot.init_db()
+    await bot.db_pool.close()
+    seed(path, n_messages, n_clients)
+
+    await bot.db_pool.open()
+    queries = {
+        "rare word": "marmellata",
+        "common word": "permesso",
+        "two words": "soggiorno scaduto",
+        "prefix": "rinn",
+        "cyrillic": "довідка",
+        "surname": "Rossi12",
+        "phone fragment": "3912",
+    }
+    for label, q in queries.items():
+        rows = await bot.search_tickets(q)  # warm
+        times = []
+        for _ in range(20):
+            t = time.perf_counter()
+            await bot.search_tickets(q)
+            times.append((time.perf_counter() - t) * 1000)
+        print(f"{label:15} {q!r:22} {len(rows):2} hits  median {statistics.median(times):7.2f} ms  max {max(times):7.2f} ms")
+    await bot.db_pool.close()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    n_messages, n_clients = (args + [1_000_000, 50_000][len(args):])[:2]
+    asyncio.run(run(n_messages, n_clients))
@@ -0,0 +1,468 @@
+"""
+End-to-end load test against a local fake Bot API.
+
+    python bench/bench_load.py [--clients 200] [--operators 5] [--messages 5]
+                               [--api-latency-ms 20] [--think-ms 30]
+                               [--save result.json] [--baseline result.json]
+
+Starts an aiohttp stand-in for the Bot API (getUpdates, sendMessage,
+answerCallbackQuery, editMessageText, copyMessage(s); everything else answers
+`true`) on localhost, points bot.py at it through TELEGRAM_API_URL and runs
+bot.main() in polling mode on a throwaway DB.
+
+Synthetic traffic: every client goes /start -> lang:it -> contact -> surname ->
+name -> tgop:<service> -> first message -> --messages more lines; every new
+ticket in the operators group is picked up by one of --operators operators
+(t:reply, then a private answer that reaches the client).
+
+Reports updates/s, handler latency percentiles (dispatcher outer middleware),
+client-visible step latency, SQLite time (pool reads + writer batches) and Bot
+API calls. --save writes the numbers as JSON; --baseline prints the change
+against a previous --save. The outbox rate limits are lifted unless
+--telegram-limits is given, so the bot itself is what gets measured.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from aiohttp import web
+
+GROUP_ID = -1001234567890
+OPERATOR_BASE = 9_000_000
+CLIENT_BASE = 1_000_000
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--operators", type=int, default=5)
+    p.add_argument("--messages", type=int, default=5, help="extra lines per client after the first one")
+    p.add_argument("--api-latency-ms", type=float, default=20, help="fake Bot API response time")
+    p.add_argument("--think-ms", type=float, default=30, help="pause between a client's steps")
+    p.add_argument("--ramp-sec", type=float, default=2, help="clients start spread over this many seconds")
+    p.add_argument("--timeout", type=float, default=30, help="max wait for a single bot reply")
+    p.add_argument("--telegram-limits", action="store_true", help="keep the real outbox rate limits")
+    p.add_argument("--save", help="write results JSON here")
+    p.add_argument("--baseline", help="compare with a results JSON from --save")
+    return p.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def summary(values: list[float]) -> dict:
+    return {
+        "n": len(values),
+        "p50": round(pct(values, 50), 2),
+        "p95": round(pct(values, 95), 2),
+        "p99": round(pct(values, 99), 2),
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+
+# =========================
+# fake Bot API
+# =========================
+class FakeBotAPI:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.inbox: dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)  # chat_id -> messages the bot sent
+        self.calls = Counter()
+        self.polling = asyncio.Event()
+        self._ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def push(self, update: dict):
+        update["update_id"] = next(self._ids)
+        self.updates.put_nowait(update)
+
+    def _message(self, chat_id: int, text: str, reply_markup: str | None = None) -> dict:
+        msg = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            "text": text,
+        }
+        markup = json.loads(reply_markup) if reply_markup else {}
+        if "inline_keyboard" in markup:  # reply keyboards are not part of a Message
+            msg["reply_markup"] = markup
+        return msg
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(data)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(data["chat_id"])
+            result = self._message(chat_id, data.get("text", ""), data.get("reply_markup"))
+            self.inbox[chat_id].put_nowait(result)
+        elif method == "copyMessage":
+            result = {"message_id": next(self._message_ids)}
+        elif method == "copyMessages":
+            result = [{"message_id": next(self._message_ids)} for _ in json.loads(data["message_ids"])]
+        else:  # answerCallbackQuery, deleteWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, data: dict) -> list:
+        self.polling.set()
+        timeout = float(data.get("timeout") or 0)
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(batch) < 100:
+            batch.append(self.updates.get_nowait())
+        return batch
+
+
+def reply_is(key: str):
+    """Matches a bot message rendered from T["it"][key] (compared up to its first placeholder)."""
+    prefix = bot.T["it"][key].split("{")[0]
+    return lambda m: m["text"].startswith(prefix)
+
+
+def message_update(user_id: int, chat_id: int, **content) -> dict:
+    return {"message": {
+        "message_id": random.randrange(1, 2**31), "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        **content,
+    }}
+
+
+def callback_update(user_id: int, chat_id: int, data: str) -> dict:
+    return {"callback_query": {
+        "id": str(random.randrange(1, 2**62)), "chat_instance": "bench", "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        "message": {
+            "message_id": random.randrange(1, 2**31), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}, "text": "·",
+        },
+    }}
+
+
+# =========================
+# traffic
+# =========================
+class Traffic:
+    def __init__(self, api: FakeBotAPI, args):
+        self.api = api
+        self.args = args
+        self.steps: dict[str, list[float]] = defaultdict(list)  # client-visible latency per step, ms
+        self.errors = Counter()
+        self.answered = 0
+        self._operator_locks = [asyncio.Lock() for _ in range(args.operators)]
+        self._next_operator = itertools.count()
+
+    async def _expect(self, chat_id: int, step: str, t0: float, match=None):
+        inbox = self.api.inbox[chat_id]
+        deadline = t0 + self.args.timeout
+        while True:
+            try:
+                msg = await asyncio.wait_for(inbox.get(), max(0.0, deadline - time.perf_counter()))
+            except asyncio.TimeoutError:
+                self.errors[f"timeout:{step}"] += 1
+                return None
+            if match is None or match(msg):
+                self.steps[step].append((time.perf_counter() - t0) * 1000)
+                return msg
+
+    def _drain(self, chat_id: int):
+        inbox = self.api.inbox[chat_id]
+        while not inbox.empty():
+            inbox.get_nowait()
+
+    async def _think(self):
+        await asyncio.sleep(self.args.think_ms / 1000 * random.uniform(0.5, 1.5))
+
+    async def client(self, n: int):
+        uid = CLIENT_BASE + n
+        await asyncio.sleep(random.uniform(0, self.args.ramp_sec))
+        steps = (  # (step, update, T key of the reply that ends the step)
+            ("start", message_update(uid, uid, text="/start"), "choose_lang"),
+            ("lang", callback_update(uid, uid, "lang:it"), "welcome_need_phone"),
+            ("phone", message_update(uid, uid, contact={"phone_number": f"39333{n:07d}", "first_name": "C", "user_id": uid}),
+             "enter_surname"),
+            ("surname", message_update(uid, uid, text=f"Rossi{n}"), "enter_name"),
+            ("name", message_update(uid, uid, text="Mario"), "menu"),
+            ("service", callback_update(uid, uid, "tgop:ISEE"), "write_to_operator_for"),
+            ("first_message", message_update(uid, uid, text=f"Buongiorno, ho bisogno dell'ISEE ({n})"), "request_sent"),
+        )
+        for step, update, key in steps:
+            self._drain(uid)
+            t0 = time.perf_counter()
+            self.api.push(update)
+            reply = await self._expect(uid, step, t0, reply_is(key))
+            if reply is None:
+                return
+            await self._think()
+        ticket_id = re.search(r"DD-\d{4}-\d+", reply["text"]).group(0)  # from request_sent
+
+        t0 = time.perf_counter()
+        for i in range(self.args.messages):
+            self.api.push(message_update(uid, uid, text=f"riga {i} per il ticket, allego documenti domani"))
+            await self._think()
+        # the operator's answer (bench marker) closes the loop; an operator whose active
+        # chat was switched by another client's message may answer the wrong one
+        answer = await self._expect(uid, "operator_answer", t0, lambda m: "[bench]" in m["text"])
+        if answer is not None:
+            self.answered += 1
+            if ticket_id not in answer["text"]:
+                self.errors["misrouted_answer"] += 1
+
+    async def operators(self):
+        pending = set()
+        seen = set()
+        inbox = self.api.inbox[GROUP_ID]
+        while True:
+            msg = await inbox.get()
+            for row in msg.get("reply_markup", {}).get("inline_keyboard", []):
+                for button in row:
+                    data = button.get("callback_data", "")
+                    if data.startswith("t:reply:") and data not in seen:
+                        seen.add(data)
+                        task = asyncio.create_task(self._operator_answer(data.split(":")[2]))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+
+    async def _operator_answer(self, ticket_id: str):
+        i = next(self._next_operator) % self.args.operators
+        op = OPERATOR_BASE + i
+        async with self._operator_locks[i]:  # one active chat per operator at a time
+            t0 = time.perf_counter()
+            self.api.push(callback_update(op, GROUP_ID, f"t:reply:{ticket_id}"))
+            is_active = reply_is("active_chat_on")
+            claimed = await self._expect(op, "operator_claim", t0, lambda m: is_active(m) and ticket_id in m["text"])
+            if claimed is None:
+                return
+            await self._think()
+            self.api.push(message_update(op, op, text=f"[bench] Buongiorno, ci servono i documenti per {ticket_id}"))
+            await self._expect(op, "operator_send", time.perf_counter(), reply_is("sent_ok"))
+
+
+# =========================
+# instrumentation
+# =========================
+class Probe:
+    """Times dispatcher updates and DB pool calls from the outside; bot.py is not modified."""
+
+    def __init__(self, bot_module):
+        self.handler_ms: dict[str, list[float]] = defaultdict(list)
+        self.last_update = 0.0
+        self.db_read_ms: list[float] = []
+        self.db_write_batches: list[tuple[int, float]] = []  # (statements, ms)
+        self.updates = 0
+        self._install(bot_module)
+
+    def _install(self, bot_module):
+        pool = bot_module.db_pool
+
+        async def timed_update(handler, event, data):
+            kind = "callback" if event.callback_query else "message"
+            t0 = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                self.last_update = time.perf_counter()
+                self.handler_ms[kind].append((self.last_update - t0) * 1000)
+                self.updates += 1
+
+        bot_module.dp.update.outer_middleware(timed_update)
+
+        for name in ("fetchone", "fetchall"):
+            orig = getattr(pool, name)
+
+            async def timed_read(*a, _orig=orig, **kw):
+                kw.setdefault("name", bot_module._caller())  # keep the bot's per-query metric label
+                t0 = time.perf_counter()
+                try:
+                    return await _orig(*a, **kw)
+                finally:
+                    self.db_read_ms.append((time.perf_counter() - t0) * 1000)
+
+            setattr(pool, name, timed_read)
+
+        orig_batch = pool._run_batch
+
+        async def timed_batch(batch):
+            t0 = time.perf_counter()
+            try:
+                return await orig_batch(batch)
+            finally:
+                self.db_write_batches.append((len(batch), (time.perf_counter() - t0) * 1000))
+
+        pool._run_batch = timed_batch
+
+
+# =========================
+# run
+# =========================
+async def run(args) -> dict:
+    api = FakeBotAPI(args.api_latency_ms)
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    bot.db_pool.path = os.path.join(tempfile.mkdtemp(prefix="doloni-load-"), "load.db")
+    probe = Probe(bot)
+    main_task = asyncio.create_task(bot.main())
+    await asyncio.wait_for(api.polling.wait(), 30)
+
+    traffic = Traffic(api, args)
+    operators = asyncio.create_task(traffic.operators())
+    rss0 = _rss_mb()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(traffic.client(n) for n in range(args.clients)))
+    wall = time.perf_counter() - t0
+    updates = probe.updates
+    busy = max(1e-9, probe.last_update - t0)  # excludes trailing reply timeouts
+
+    operators.cancel()
+    await bot.dp.stop_polling()
+    await main_task
+    await runner.cleanup()
+
+    all_handlers = [v for vals in probe.handler_ms.values() for v in vals]
+    write_ms = [ms for _, ms in probe.db_write_batches]
+    statements = sum(n for n, _ in probe.db_write_batches)
+    return {
+        "config": {k: getattr(args, k) for k in ("clients", "operators", "messages", "api_latency_ms",
+                                                 "think_ms", "ramp_sec", "telegram_limits")},
+        "wall_sec": round(wall, 2),
+        "updates": updates,
+        "updates_per_sec": round(updates / busy, 1),
+        "answered": traffic.answered,
+        "errors": dict(traffic.errors),
+        "handler_ms": {"all": summary(all_handlers), **{k: summary(v) for k, v in probe.handler_ms.items()}},
+        "steps_ms": {k: summary(v) for k, v in traffic.steps.items()},
+        "sqlite": {
+            "reads": len(probe.db_read_ms),
+            "read_ms_total": round(sum(probe.db_read_ms), 1),
+            "read_ms": summary(probe.db_read_ms),
+            "write_batches": len(write_ms),
+            "write_statements": statements,
+            "write_ms_total": round(sum(write_ms), 1),
+            "write_batch_ms": summary(write_ms),
+            "ms_per_update": round((sum(probe.db_read_ms) + sum(write_ms)) / max(1, updates), 3),
+        },
+        "api_calls": dict(api.calls),
+        "rss_mb": {"before": rss0, "after": _rss_mb()},
+    }
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return 0.0
+
+
+def report(res: dict, baseline: dict | None):
+    def line(label, cur, base_val=None, unit=""):
+        delta = ""
+        if base_val:
+            delta = f"  ({(cur - base_val) / base_val * 100:+.1f}% vs baseline {base_val}{unit})"
+        print(f"  {label:<28}{cur}{unit}{delta}")
+
+    def get(d, *path):
+        for p in path:
+            if not isinstance(d, dict) or p not in d:
+                return None
+            d = d[p]
+        return d
+
+    b = baseline or {}
+    print(f"\nconfig: {res['config']}")
+    print(f"wall {res['wall_sec']}s, {res['updates']} updates, answered {res['answered']}/{res['config']['clients']}")
+    if res["errors"]:
+        print(f"errors: {res['errors']}")
+    print("throughput")
+    line("updates/s", res["updates_per_sec"], get(b, "updates_per_sec"))
+    print("handler latency (ms)")
+    for kind, s in res["handler_ms"].items():
+        for q in ("p50", "p95", "p99"):
+            line(f"{kind} {q}", s[q], get(b, "handler_ms", kind, q))
+    print("client-visible step latency (ms, p50 / p95 / p99)")
+    for step, s in res["steps_ms"].items():
+        print(f"  {step:<28}{s['p50']} / {s['p95']} / {s['p99']}  (n={s['n']})")
+    sq = res["sqlite"]
+    print("sqlite")
+    line("reads", sq["reads"], get(b, "sqlite", "reads"))
+    line("read time total", sq["read_ms_total"], get(b, "sqlite", "read_ms_total"), " ms")
+    line("read p95", sq["read_ms"]["p95"], get(b, "sqlite", "read_ms", "p95"), " ms")
+    line("write batches", sq["write_batches"], get(b, "sqlite", "write_batches"))
+    line("statements / batch", round(sq["write_statements"] / max(1, sq["write_batches"]), 2))
+    line("write time total", sq["write_ms_total"], get(b, "sqlite", "write_ms_total"), " ms")
+    line("sqlite ms / update", sq["ms_per_update"], get(b, "sqlite", "ms_per_update"))
+    print(f"bot api calls: {res['api_calls']}")
+    print(f"rss: {res['rss_mb']['before']} -> {res['rss_mb']['after']} MB")
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    PORT = free_port()
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "BOT_MODE": "polling",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{PORT}",
+        "OPERATORS_GROUP_ID": str(GROUP_ID),
+        "ADMIN_IDS": ",".join(str(OPERATOR_BASE + i) for i in range(ARGS.operators)),
+        "CATALOG_PATH": os.path.join(tempfile.gettempdir(), "doloni-load-no-catalog.json"),
+        "LIFECYCLE_INTERVAL_SEC": "3600",
+    })
+    if not ARGS.telegram_limits:
+        os.environ.update({"OUT_GLOBAL_RATE": "100000", "OUT_CHAT_RATE": "1000", "OUT_GROUP_RATE": "1000"})
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+    import bot  # noqa: E402  (env must be set first)
+
+    result = asyncio.run(run(ARGS))
+    base = None
+    if ARGS.baseline:
+        with open(ARGS.baseline) as f:
+            base = json.load(f)
+    report(result, base)
+    if ARGS.save:
+        with open(ARGS.save, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved {ARGS.save}")
@@ -0,0 +1,101 @@
+"""
+Ticket id allocation cost with a large tickets table.
+
+    python bench/bench_ticket_ids.py [existing_tickets] [allocations] [concurrency] [legacy_random]
+
+Builds a throwaway DB with `existing_tickets` sequential rows (default 1M, at
+most 500k per year going back from the current one, since a year tops out at
+DD-YYYY-999999) plus `legacy_random` ids with random digits in the current year
+(default 1000, like installs older than the sequence), seeds the counter with the migration's statement, then allocates
+`allocations` new ids through bot.create_ticket from `concurrency` concurrent
+tasks and reports per-call latency. Nothing touches doloni.db or Telegram.
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+
+PER_YEAR = 500_000
+
+
+def seed(path: str, n: int, year: int, legacy: int):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    batch = 50_000
+    y = year
+    while n > 0:
+        count = min(n, PER_YEAR)
+        then = f"{y}-01-01T00:00:00+00:00"
+        for start in range(0, count, batch):
+            conn.executemany(
+                "INSERT INTO tickets (ticket_id, client_tg_id, service, status, assigned_operator_id, created_at, updated_at) "
+                "VALUES (?, ?, 'ISEE', 'closed', NULL, ?, ?)",
+                ((bot.format_ticket_id(y, i + 1), i % 50_000, then, then) for i in range(start, min(count, start + batch))),
+            )
+        n -= count
+        y -= 1
+    now = f"{year}-01-01T00:00:00+00:00"
+    conn.executemany(
+        "INSERT OR IGNORE INTO tickets (ticket_id, client_tg_id, service, status, assigned_operator_id, created_at, updated_at) "
+        "VALUES (?, 0, 'ISEE', 'closed', NULL, ?, ?)",
+        ((bot.format_ticket_id(year, random.randint(1, bot.TICKET_SEQ_MAX)), now, now) for _ in range(legacy)),
+    )
+    conn.execute("DELETE FROM ticket_seq")
+    conn.execute(bot._TICKET_SEQ_SEED)
+    conn.commit()
+    conn.close()
+
+
+async def run(existing: int, allocations: int, concurrency: int, legacy: int):
+    path = os.path.join(tempfile.mkdtemp(prefix="doloni-bench-"), "bench.db")
+    bot.db_pool.path = path
+    await bot.db_pool.open()
+    await bot.init_db()
+    await bot.db_pool.close()
+
+    year = time.gmtime().tm_year
+    t0 = time.perf_counter()
+    seed(path, existing, year, legacy)
+    print(f"seeded {existing:,} tickets + {legacy:,} legacy random ids in {time.perf_counter() - t0:.1f}s")
+
+    await bot.db_pool.open()
+    latencies: list[float] = []
+    ids: list[str] = []
+    per_task = allocations // concurrency
+
+    async def worker(w: int):
+        for i in range(per_task):
+            t = time.perf_counter()
+            ids.append(await bot.create_ticket(10_000_000 + w * per_task + i, "ISEE"))
+            latencies.append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    wall = time.perf_counter() - t0
+    await bot.db_pool.close()
+
+    assert len(set(ids)) == len(ids), "duplicate ticket ids"
+    assert all(len(i) == len("DD-0000-000000") for i in ids), "ticket id wider than DD-YYYY-NNNNNN"
+    lat = sorted(latencies)
+    q = statistics.quantiles(lat, n=100)
+    print(f"{len(ids):,} allocations, concurrency {concurrency}: {len(ids) / wall:,.0f}/s")
+    print(f"latency ms  p50={q[49] * 1000:.2f}  p95={q[94] * 1000:.2f}  p99={q[98] * 1000:.2f}  max={lat[-1] * 1000:.2f}")
+    print(f"first={ids[0]} last={max(ids)}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    existing, allocations, concurrency, legacy = (args + [1_000_000, 2_000, 8, 1_000][len(args):])[:4]
+    asyncio.run(run(existing, allocations, concurrency, legacy))
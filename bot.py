@@ -1,25 +1,45 @@
 import os
 import asyncio
+import csv
+import html
+import io
+import json
 import logging
-import random
+import re
+import secrets
+import signal
+import sqlite3
 import string
-from datetime import datetime, UTC
+import sys
+import tempfile
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime, timedelta, UTC
+from functools import lru_cache
+from typing import NamedTuple
 
 import aiosqlite
+from aiohttp import web
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ChatType, ContentType, ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import (
-    Message, CallbackQuery,
+    Message, CallbackQuery, InputFile,
     InlineKeyboardMarkup, InlineKeyboardButton,
-    KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+    KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, ReplyParameters
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import CopyMessage, CopyMessages, EditMessageText, SendDocument, SendMessage, TelegramMethod
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 
 # =========================
@@ -41,6 +61,24 @@ WA2 = "393286058012"
 
 DB_PATH = "doloni.db"
 
+# Updates: "polling" (default) or "webhook".
+# In webhook mode WEBHOOK_BASE_URL is the public https origin Telegram should call;
+# leave it empty to run the endpoint locally without registering it, then POST updates by hand:
+#   curl -X POST localhost:8080/tg/webhook -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' \
+#        -H 'Content-Type: application/json' -d @update.json
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook").strip() or "/tg/webhook"
+# required once WEBHOOK_BASE_URL registers a public URL: without it anyone who finds
+# the path can post forged updates (e.g. from an admin id). Telegram allows [A-Za-z0-9_-]{1,256}.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0").strip()
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080").strip() or "8080")
+
+# Bot API server: empty = api.telegram.org. Set it for a self-hosted telegram-bot-api
+# or for the fake server in bench/bench_load.py, e.g. http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("doloni-bot")
 
@@ -75,6 +113,8 @@ T = {
         "request_sent": "✅ Richiesta inviata a <b>Doloni Documenti</b>.\n<b>ID:</b> {ticket}\nTi risponderemo qui.",
         "request_sent_short": "✅ Richiesta inviata.\n<b>ID:</b> {ticket}",
         "ticket_closed": "✅ La conversazione è stata chiusa.\nSe hai bisogno, scrivi di nuovo qui.",
+        "ticket_reminder": "⏰ <b>{ticket}</b>: il cliente aspetta una risposta da {minutes} min.",
+        "flood_slow_down": "⏳ Troppi messaggi, rallenta un attimo.",
         "open_whatsapp": "📲 Apri WhatsApp: {link}",
         "open_whatsapp_service": "📲 WhatsApp ({service}): {link}",
         "admin_denied": "Accesso negato.",
@@ -83,15 +123,32 @@ T = {
         "admin_progress": "⏳ In lavorazione",
         "admin_closed": "✅ Chiusi",
         "admin_search": "🔎 Cerca (scrivi ID)",
-        "admin_search_ask": "Scrivi l’ID del ticket (es: DD-2026-123456).",
+        "admin_search_ask": "Scrivi l’ID del ticket (es: DD-2026-123456) oppure nome, telefono o una frase.",
+        "find_usage": "Uso: /find testo (cognome, telefono, frase dalla conversazione).",
+        "find_none": "Nessun risultato.",
+        "find_results": "🔎 Risultati per «{query}»:\n{lines}",
+        "history_usage": "Uso: /history ID [csv|jsonl]",
+        "history_header": "🗂 Conversazione <b>{id}</b> — {service} — <i>{status}</i>",
+        "history_export": "🗂 {id} — {service} — {status}",
+        "history_empty": "Nessun messaggio in questo ticket.",
+        "history_truncated": "… conversazione troppo lunga, scarica tutto con /history {id} csv",
         "ticket_not_found": "Ticket non trovato.",
         "tickets_none": "Nessun ticket in questa lista.",
         "tickets_list": "📋 Tickets:\n{lines}",
+        "tickets_page": "📋 Tickets <i>{status}</i>{filters} — pagina {page}:\n{lines}",
+        "tickets_usage": "Uso: /tickets new|in_progress|closed [service=ISEE] [op=ID|none] [from=AAAA-MM-GG] [to=AAAA-MM-GG] [size=N]",
+        "page_expired": "Lista scaduta, riaprila da /admin.",
+        "page_not_yours": "Questa lista è di un altro operatore: apri la tua da /admin.",
         "ticket_found": "✅ Trovato: <b>{id}</b>\nServizio: {service}\nStatus: {status}\nAssegnato: {assigned}",
         "only_operators": "Solo operatori.",
         "already_taken": "Già preso da un altro operatore.",
         "taken_ok": "Preso in carico ✅",
         "assigned_other": "Ticket assegnato a un altro operatore.",
+        "ticket_wrong_state": "Ticket {ticket}: stato «{status}», azione non disponibile.",
+        "reopen_usage": "Uso: /reopen ID",
+        "reopen_client_busy": "Ticket {ticket} non riaperto: il cliente ha già il ticket aperto <b>{other}</b>.",
+        "reopened_ok": "🔓 Ticket <b>{ticket}</b> riaperto ({status}).",
+        "ticket_card": "{icon} <b>Ticket {ticket}</b> — {service}\nCliente: {name} {surname} | +{phone}\nStato: <i>{status}</i> | Operatore: {operator}\n{last}",
         "active_chat_on": "✅ Chat attiva: <b>{ticket}</b>\nOra puoi scrivere qui in privato: ogni messaggio verrà inviato al cliente.\nPer uscire: /stop",
         "active_chat_off": "⛔️ Chat disattivata (era: <b>{ticket}</b>).",
         "no_active_chat": "Non hai una chat attiva.",
@@ -100,7 +157,6 @@ T = {
         "talk_to_operator": "💬 Parlare con un operatore",
         "ticket_new_prefix": "🆕",
         "ticket_msg_prefix": "📩",
-        "ticket_text_new": "🆕 <b>Ticket {ticket}</b>\nCliente: {name} {surname}\nTel: +{phone}\nServizio: {service}\nMessaggio: “{msg}”",
         "ticket_text_msg": "📩 <b>Ticket {ticket}</b> (messaggio cliente)\n{name} {surname} | +{phone}\n“{msg}”",
         "claim_btn": "✅ Prendi in carico",
         "reply_btn": "✉️ Rispondi",
@@ -108,6 +164,9 @@ T = {
         "docs_title": "<b>{service}</b> — Documenti necessari:\n{txt}",
         "price_title": "<b>{service}</b> — Prezzo indicativo:\n{txt}",
         "lang_set": "✅ Lingua impostata.",
+        "admin_reload_catalog": "🔄 Ricarica servizi/prezzi",
+        "catalog_reloaded": "✅ Catalogo ricaricato: {count} servizi (versione {version}).",
+        "catalog_reload_failed": "❌ Catalogo non ricaricato, resta la versione {version}.\n<code>{error}</code>",
     },
     "uk": {
         "choose_lang": "🌐 Оберіть мову:",
@@ -135,6 +194,8 @@ T = {
         "request_sent": "✅ Запит надіслано до <b>Doloni Documenti</b>.\n<b>ID:</b> {ticket}\nМи відповімо вам тут.",
         "request_sent_short": "✅ Запит надіслано.\n<b>ID:</b> {ticket}",
         "ticket_closed": "✅ Діалог закрито.\nЯкщо буде потрібно — напишіть нам тут знову.",
+        "ticket_reminder": "⏰ <b>{ticket}</b>: клієнт чекає на відповідь уже {minutes} хв.",
+        "flood_slow_down": "⏳ Забагато повідомлень, зачекайте трохи.",
         "open_whatsapp": "📲 Відкрити WhatsApp: {link}",
         "open_whatsapp_service": "📲 WhatsApp ({service}): {link}",
         "admin_denied": "Доступ заборонено.",
@@ -143,15 +204,32 @@ T = {
         "admin_progress": "⏳ В роботі",
         "admin_closed": "✅ Закриті",
         "admin_search": "🔎 Пошук (введіть ID)",
-        "admin_search_ask": "Введіть ID тікету (наприклад: DD-2026-123456).",
+        "admin_search_ask": "Введіть ID тікету (наприклад: DD-2026-123456) або ім’я, телефон чи фразу.",
+        "find_usage": "Формат: /find текст (прізвище, телефон, фраза з розмови).",
+        "find_none": "Нічого не знайдено.",
+        "find_results": "🔎 Результати для «{query}»:\n{lines}",
+        "history_usage": "Формат: /history ID [csv|jsonl]",
+        "history_header": "🗂 Розмова <b>{id}</b> — {service} — <i>{status}</i>",
+        "history_export": "🗂 {id} — {service} — {status}",
+        "history_empty": "У цьому тікеті немає повідомлень.",
+        "history_truncated": "… розмова задовга, завантажте повністю: /history {id} csv",
         "ticket_not_found": "Тікет не знайдено.",
         "tickets_none": "У цьому списку немає тікетів.",
         "tickets_list": "📋 Тікети:\n{lines}",
+        "tickets_page": "📋 Тікети <i>{status}</i>{filters} — сторінка {page}:\n{lines}",
+        "tickets_usage": "Формат: /tickets new|in_progress|closed [service=ISEE] [op=ID|none] [from=РРРР-ММ-ДД] [to=РРРР-ММ-ДД] [size=N]",
+        "page_expired": "Список застарів, відкрийте його знову з /admin.",
+        "page_not_yours": "Цей список відкрив інший оператор: відкрийте свій з /admin.",
         "ticket_found": "✅ Знайдено: <b>{id}</b>\nПослуга: {service}\nСтатус: {status}\nПризначено: {assigned}",
         "only_operators": "Тільки для операторів.",
         "already_taken": "Вже взято іншим оператором.",
         "taken_ok": "Взято в роботу ✅",
         "assigned_other": "Тікет призначено іншому оператору.",
+        "ticket_wrong_state": "Тікет {ticket}: статус «{status}», дія недоступна.",
+        "reopen_usage": "Формат: /reopen ID",
+        "reopen_client_busy": "Тікет {ticket} не відкрито: у клієнта вже є відкритий тікет <b>{other}</b>.",
+        "reopened_ok": "🔓 Тікет <b>{ticket}</b> знову відкрито ({status}).",
+        "ticket_card": "{icon} <b>Тікет {ticket}</b> — {service}\nКлієнт: {name} {surname} | +{phone}\nСтатус: <i>{status}</i> | Оператор: {operator}\n{last}",
         "active_chat_on": "✅ Активний чат: <b>{ticket}</b>\nТепер пишіть тут у приват — кожне повідомлення піде клієнту.\nВийти: /stop",
         "active_chat_off": "⛔️ Чат вимкнено (був: <b>{ticket}</b>).",
         "no_active_chat": "У вас немає активного чату.",
@@ -160,7 +238,6 @@ T = {
         "talk_to_operator": "💬 Поспілкуватися з оператором",
         "ticket_new_prefix": "🆕",
         "ticket_msg_prefix": "📩",
-        "ticket_text_new": "🆕 <b>Тікет {ticket}</b>\nКлієнт: {name} {surname}\nТел: +{phone}\nПослуга: {service}\nПовідомлення: “{msg}”",
         "ticket_text_msg": "📩 <b>Тікет {ticket}</b> (повідомлення клієнта)\n{name} {surname} | +{phone}\n“{msg}”",
         "claim_btn": "✅ Взяти",
         "reply_btn": "✉️ Відповісти",
@@ -168,14 +245,12 @@ T = {
         "docs_title": "<b>{service}</b> — Потрібні документи:\n{txt}",
         "price_title": "<b>{service}</b> — Орієнтовна вартість:\n{txt}",
         "lang_set": "✅ Мову встановлено.",
+        "admin_reload_catalog": "🔄 Оновити послуги/ціни",
+        "catalog_reloaded": "✅ Каталог оновлено: {count} послуг (версія {version}).",
+        "catalog_reload_failed": "❌ Каталог не оновлено, залишається версія {version}.\n<code>{error}</code>",
     }
 }
 
-def tr(lang: str, key: str, **kwargs) -> str:
-    lang = lang if lang in T else "it"
-    return T[lang][key].format(**kwargs)
-
-
 # =========================
 # CONTENT (docs/prices) in both langs
 # service keys are stable; labels shown can be bilingual-friendly
@@ -228,6 +303,212 @@ PRICE = {
 }
 
 
+# =========================
+# i18n (compiled)
+# T above is the source; compile_i18n() validates it and builds _CATALOG[lang][key]:
+# constant strings are stored pre-rendered, templates as a bound str.format.
+# tr() is then a dict hit plus (for templates) one format call.
+# =========================
+DEFAULT_LANG = "it"
+_FORMATTER = string.Formatter()
+
+
+def _template_fields(text: str) -> set[str]:
+    return {field for _, field, _, _ in _FORMATTER.parse(text) if field is not None}
+
+
+def compile_i18n(t: dict) -> dict:
+    problems = []
+    langs = list(t)
+    base = set(t[DEFAULT_LANG])
+    for lang in langs:
+        keys = set(t[lang])
+        for k in sorted(base - keys):
+            problems.append(f"T[{lang!r}] missing {k!r}")
+        for k in sorted(keys - base):
+            problems.append(f"T[{lang!r}] has extra {k!r}")
+
+    catalog: dict[str, dict] = {}
+    for lang in langs:
+        compiled = {}
+        for key, text in t[lang].items():
+            try:
+                fields = _template_fields(text)
+            except ValueError as e:
+                problems.append(f"T[{lang!r}][{key!r}]: bad template ({e})")
+                continue
+            if key in t[DEFAULT_LANG] and lang != DEFAULT_LANG:
+                ref = _template_fields(t[DEFAULT_LANG][key])
+                if fields != ref:
+                    problems.append(f"T[{lang!r}][{key!r}] placeholders {sorted(fields)} != {sorted(ref)}")
+            compiled[key] = text.format if fields else text.format()
+        catalog[lang] = compiled
+
+    if problems:
+        raise RuntimeError("i18n catalog invalid:\n  " + "\n  ".join(problems))
+    return catalog
+
+
+_CATALOG = compile_i18n(T)
+
+
+def tr(lang: str, key: str, **kwargs) -> str:
+    v = (_CATALOG.get(lang) or _CATALOG[DEFAULT_LANG])[key]
+    return v if v.__class__ is str else v(**kwargs)
+
+
+# =========================
+# SERVICE CATALOG (hot-reloadable)
+# SERVICE_KEYS/DOCS/PRICE above are the built-in defaults. At startup they are
+# written to CATALOG_PATH if it doesn't exist; after that the file is the source
+# of truth. A watcher polls its mtime and swaps in a new immutable ServiceCatalog
+# in one assignment, so handlers that read `services.current` once always see a
+# consistent snapshot without locks. Admins can also force a reload from /admin.
+# =========================
+CATALOG_PATH = os.getenv("CATALOG_PATH", "catalog.json").strip() or "catalog.json"
+CATALOG_POLL_SEC = float(os.getenv("CATALOG_POLL_SEC", "5").strip() or "5")
+
+
+class ServiceCatalog(NamedTuple):
+    service_keys: tuple[tuple[str, str], ...]
+    info: dict  # (lang, service_key, 'docs'|'price') -> rendered message
+    version: str
+
+
+def build_service_catalog(service_keys, docs: dict, price: dict, version: str = "builtin") -> ServiceCatalog:
+    # catalog.json is edited by hand: a wrong shape must be a ValueError like any other mistake
+    if not isinstance(service_keys, (list, tuple)):
+        raise ValueError(f"service catalog invalid: services must be a list, got {type(service_keys).__name__}")
+    for kind, source in (("docs", docs), ("price", price)):
+        if not isinstance(source, dict) or not all(isinstance(v, dict) for v in source.values()):
+            raise ValueError(f"service catalog invalid: {kind} must map language -> {{service: text}}")
+    problems = []
+    keys = []
+    for item in service_keys:
+        if not (isinstance(item, (list, tuple)) and len(item) == 2 and all(isinstance(x, str) for x in item)):
+            problems.append(f"services: bad entry {item!r} (want [key, label])")
+            continue
+        keys.append((item[0], item[1]))
+    if len({k for k, _ in keys}) != len(keys):
+        problems.append("services: duplicate keys")
+    for k, _ in keys:
+        # keys travel in callback_data ("info:<key>:price"), which Telegram caps at 64 bytes
+        if ":" in k or len(k.encode()) > 40:
+            problems.append(f"services: key {k!r} must be short and contain no ':'")
+
+    info = {}
+    for lang in _CATALOG:
+        for k, _ in keys:
+            for kind, source in (("docs", docs), ("price", price)):
+                txt = source.get(lang, {}).get(k)
+                if not isinstance(txt, str):
+                    problems.append(f"{kind.upper()}[{lang!r}] missing service {k!r}")
+                    continue
+                info[(lang, k, kind)] = tr(lang, f"{kind}_title", service=k, txt=txt)
+
+    if problems:
+        raise ValueError("service catalog invalid:\n  " + "\n  ".join(problems))
+    return ServiceCatalog(tuple(keys), info, version)
+
+
+class ServiceCatalogStore:
+    def __init__(self, path: str, poll_sec: float = 5):
+        self.path = path
+        self.poll_sec = poll_sec
+        self.current = build_service_catalog(SERVICE_KEYS, DOCS, PRICE)
+        self._mtime: float | None = None
+        self._task: asyncio.Task | None = None
+
+    def _read_file(self) -> ServiceCatalog:
+        with open(self.path, encoding="utf-8") as f:
+            raw = json.load(f)
+        if not isinstance(raw, dict):
+            raise ValueError(f"service catalog invalid: top level must be an object, got {type(raw).__name__}")
+        mtime = os.stat(self.path).st_mtime
+        cat = build_service_catalog(raw.get("services", []), raw.get("docs", {}), raw.get("price", {}),
+                                    version=datetime.fromtimestamp(mtime, UTC).isoformat(timespec="seconds"))
+        self._mtime = mtime
+        return cat
+
+    def _swap(self, cat: ServiceCatalog):
+        self.current = cat
+        # kb_main_menu is built from the catalog: rebuild it synchronously, before any
+        # other coroutine can run, so old keyboards never pair with the new snapshot
+        reset_keyboards()
+        warm_keyboards()
+        log.info("Service catalog loaded: %s services (version %s)", len(cat.service_keys), cat.version)
+
+    def load(self):
+        """Startup: seed the file from the built-in defaults if missing, then load it (errors are fatal)."""
+        if not os.path.exists(self.path):
+            data = {
+                "services": [list(x) for x in SERVICE_KEYS],
+                "docs": DOCS,
+                "price": PRICE,
+            }
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.path)
+            log.info("Service catalog seeded from built-in defaults: %s", self.path)
+        self._swap(self._read_file())
+
+    def reload(self) -> str | None:
+        """Reload from file; on error keeps the current snapshot and returns the error text."""
+        try:
+            cat = self._read_file()
+        except (OSError, ValueError) as e:
+            # json.JSONDecodeError is a ValueError too
+            log.error("Service catalog reload failed, keeping version %s: %s", self.current.version, e)
+            try:
+                self._mtime = os.stat(self.path).st_mtime  # don't retry the same broken file every poll
+            except OSError:
+                pass
+            return str(e)
+        self._swap(cat)
+        return None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch(), name="catalog-watch")
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_sec)
+            try:
+                try:
+                    mtime = os.stat(self.path).st_mtime
+                except OSError:
+                    continue
+                if mtime != self._mtime:
+                    self.reload()
+            except Exception:
+                # never let a bad file end hot reload until the next restart
+                log.exception("Service catalog watcher error")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+services = ServiceCatalogStore(CATALOG_PATH, poll_sec=CATALOG_POLL_SEC)
+
+
+def info_text(lang: str, service_key: str, kind: str) -> str:
+    """Rendered docs/price message; kind is 'docs' or 'price'."""
+    lang = lang if lang in _CATALOG else DEFAULT_LANG
+    text = services.current.info.get((lang, service_key, kind))
+    if text is None:
+        # unknown service (stale button): same fallback as before
+        text = tr(lang, f"{kind}_title", service=service_key, txt="—")
+    return text
+
+
 # =========================
 # FSM (client)
 # =========================
@@ -243,13 +524,6 @@ class AdminSearch(StatesGroup):
     wait_ticket_id = State()
 
 
-# =========================
-# ACTIVE CHAT (operator -> ticket)
-# operator_id -> ticket_id
-# =========================
-ACTIVE_TICKET: dict[int, str] = {}
-
-
 # =========================
 # HELPERS
 # =========================
@@ -259,25 +533,443 @@ def is_admin(user_id: int) -> bool:
 def is_command_text(text: str | None) -> bool:
     return bool(text) and text.strip().startswith("/")
 
+def message_media(message: Message) -> tuple[str | None, str | None]:
+    """(content_type, file_id) of a non-text message; file_id is None for locations, contacts etc."""
+    if message.text is not None:
+        return None, None
+    kind = ContentType(message.content_type).value
+    media = getattr(message, kind, None)
+    if isinstance(media, list):  # photo: sizes, largest last
+        media = media[-1] if media else None
+    return kind, getattr(media, "file_id", None)
+
 def choose_whatsapp_for_client(tg_id: int) -> str:
     return WA1 if (tg_id % 2 == 0) else WA2
 
-def gen_ticket_id() -> str:
-    year = datetime.now(UTC).year
-    num = "".join(random.choice(string.digits) for _ in range(6))
-    return f"DD-{year}-{num}"
+TICKET_SEQ_MAX = 999_999  # DD-YYYY-NNNNNN: six digits per year, never wider
+
+
+def format_ticket_id(year: int, seq: int) -> str:
+    if not 0 < seq <= TICKET_SEQ_MAX:
+        raise ValueError(f"ticket sequence {seq} outside 1..{TICKET_SEQ_MAX}")
+    return f"DD-{year}-{seq:06d}"
 
 def wa_link(phone_digits: str, text: str) -> str:
     from urllib.parse import quote
     return f"https://wa.me/{phone_digits}?text={quote(text)}"
 
 
+# =========================
+# METRICS
+# in-process counters/histograms rendered in Prometheus text format on METRICS_PATH
+# (webhook app, or a small server on METRICS_PORT in polling mode) and summarised
+# by /metrics. Handlers, DB statements (labelled by the calling helper) and every
+# Bot API request are timed.
+# =========================
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics").strip() or "/metrics"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0").strip() or "0")  # polling mode only; 0 = off
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()              # optional: require "Authorization: Bearer <token>"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # per bucket, not cumulative
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (inf when it is past the last bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def _label_str(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._help: dict[str, str] = {}
+        self._hist: dict[str, dict[tuple, Histogram]] = {}  # name -> labels -> histogram
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._gauges: list[tuple[str, str, object]] = []    # (name, help, fn() -> number)
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._hist.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        h = series.get(key)
+        if h is None:
+            h = series[key] = Histogram(self.buckets)
+        h.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def gauge(self, name: str, help_text: str, fn):
+        self._gauges.append((name, help_text, fn))
+
+    def series(self, name: str) -> dict[tuple, Histogram]:
+        return self._hist.get(name, {})
+
+    def counters(self, name: str) -> dict[tuple, float]:
+        return self._counters.get(name, {})
+
+    def render(self) -> str:
+        out = []
+        for name, series in self._hist.items():
+            out += [f"# HELP {name} {self._help.get(name, name)}", f"# TYPE {name} histogram"]
+            for labels, h in series.items():
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    out.append(f"{name}_bucket{_label_str(labels + (('le', bound),))} {cumulative}")
+                out.append(f"{name}_bucket{_label_str(labels + (('le', '+Inf'),))} {h.count}")
+                out.append(f"{name}_sum{_label_str(labels)} {h.sum:.6f}")
+                out.append(f"{name}_count{_label_str(labels)} {h.count}")
+        for name, series in self._counters.items():
+            out += [f"# HELP {name} {self._help.get(name, name)}", f"# TYPE {name} counter"]
+            out += [f"{name}{_label_str(labels)} {value:g}" for labels, value in series.items()]
+        for name, help_text, fn in self._gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "Handler run time by handler function.")
+metrics.describe("bot_handler_errors_total", "Exceptions raised by handlers.")
+metrics.describe("bot_db_query_seconds", "DB statement time by calling helper and kind (read/write/stream/transaction).")
+metrics.describe("bot_db_errors_total", "Failed DB statements by calling helper.")
+metrics.describe("bot_db_write_wait_seconds", "Queued write: time from submit to commit.")
+metrics.describe("bot_api_seconds", "Bot API request time by method.")
+metrics.describe("bot_api_errors_total", "Failed Bot API requests by method and error.")
+metrics.describe("bot_chat_lock_wait_seconds", "Time an update waited for the previous update of the same chat.")
+
+
+def _caller(depth: int = 2) -> str:
+    # qualified name of the function that called into the DB layer: "get_client", "OperatorSessions.load"
+    return sys._getframe(depth).f_code.co_qualname
+
+
 # =========================
 # DB
+# one writer + a few readers, opened once in main() and shared by all handlers
 # =========================
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+DB_READERS = int(os.getenv("DB_READERS", "3").strip() or "3")
+DB_BATCH_MS = float(os.getenv("DB_BATCH_MS", "5").strip() or "5")      # writer groups queued writes for this long
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "200").strip() or "200")  # max statements per transaction
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384").strip() or "16384")
+DB_MMAP_MB = int(os.getenv("DB_MMAP_MB", "128").strip() or "128")
+
+# applied to every connection; journal_mode=WAL is persistent in the db file
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{DB_CACHE_KB}",
+    f"PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class DBPool:
+    """
+    WAL-mode SQLite: one writer connection + a few readers.
+    Single-statement writes go through a queue; the writer task groups everything
+    queued within DB_BATCH_MS into one transaction (one savepoint per statement,
+    so a failing statement does not roll back its neighbours).
+    """
+
+    def __init__(self, path: str, readers: int = 3, batch_ms: float = 5, batch_max: int = 200):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.batch_delay = max(0.0, batch_ms) / 1000
+        self.batch_max = max(1, batch_max)
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._reader_conns: list[aiosqlite.Connection] = []
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._writer_task: asyncio.Task | None = None
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        # autocommit mode: transactions are opened explicitly in write()/_run_batch()
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        for pragma in DB_PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect(readonly=False)
+        for _ in range(self.readers_count):
+            conn = await self._connect(readonly=True)
+            self._reader_conns.append(conn)
+            self._readers.put_nowait(conn)
+        self._writer_task = asyncio.create_task(self._writer_loop(), name="db-writer")
+        log.info("DB pool opened: %s (1 writer, %s readers, batch %sms)",
+                 self.path, self.readers_count, self.batch_delay * 1000)
+
+    async def close(self):
+        if self._writer_task is not None:
+            # sentinel: the writer flushes whatever is still queued, then exits
+            self._queue.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+        for conn in self._reader_conns:
+            await conn.close()
+        self._reader_conns.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        log.info("DB pool closed")
+
+    @asynccontextmanager
+    async def read(self):
+        if self._writer is None:
+            raise RuntimeError("DB pool is not open")
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self, name: str | None = None):
+        """Multi-statement transaction on the writer connection; commits on exit, rolls back on error."""
+        if self._writer is None:
+            raise RuntimeError("DB pool is not open")
+        name = name or _caller(3)  # write() frame <- __aenter__ <- caller
+        async with self._write_lock:
+            t0 = time.perf_counter()
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.execute("ROLLBACK")
+                metrics.inc("bot_db_errors_total", query=name)
+                raise
+            finally:
+                metrics.observe("bot_db_query_seconds", time.perf_counter() - t0, query=name, kind="transaction")
+            await self._writer.execute("COMMIT")
+
+    async def fetchone(self, sql: str, params: tuple = (), name: str | None = None):
+        name = name or _caller()
+        t0 = time.perf_counter()
+        try:
+            async with self.read() as db:
+                cur = await db.execute(sql, params)
+                return await cur.fetchone()
+        except sqlite3.Error:
+            metrics.inc("bot_db_errors_total", query=name)
+            raise
+        finally:
+            metrics.observe("bot_db_query_seconds", time.perf_counter() - t0, query=name, kind="read")
+
+    async def fetchall(self, sql: str, params: tuple = (), name: str | None = None):
+        name = name or _caller()
+        t0 = time.perf_counter()
+        try:
+            async with self.read() as db:
+                cur = await db.execute(sql, params)
+                return await cur.fetchall()
+        except sqlite3.Error:
+            metrics.inc("bot_db_errors_total", query=name)
+            raise
+        finally:
+            metrics.observe("bot_db_query_seconds", time.perf_counter() - t0, query=name, kind="read")
+
+    async def stream(self, sql: str, params: tuple = (), batch: int = 500, name: str = "stream"):
+        """
+        Yield rows one by one, fetching `batch` at a time from a single cursor.
+        Holds a reader until exhausted: wrap in contextlib.aclosing() if you may stop early.
+        Only the time spent inside SQLite counts towards the metric, not the consumer's.
+        """
+        spent = 0.0
+        try:
+            async with self.read() as db:
+                t0 = time.perf_counter()
+                async with db.execute(sql, params) as cur:
+                    while rows := await cur.fetchmany(batch):
+                        spent += time.perf_counter() - t0
+                        for row in rows:
+                            yield row
+                        t0 = time.perf_counter()
+        finally:
+            metrics.observe("bot_db_query_seconds", spent, query=name, kind="stream")
+
+    def submit(self, sql: str, params: tuple = (), name: str | None = None) -> asyncio.Future:
+        """Queue a write without waiting; the future resolves to the statement's rowcount once committed."""
+        if self._writer_task is None:
+            raise RuntimeError("DB pool is not open")
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, fut, name or _caller(), time.perf_counter(), False))
+        return fut
+
+    async def execute(self, sql: str, params: tuple = (), wait: bool = True, name: str | None = None) -> int | None:
+        """
+        Queue a write for the batching writer.
+        wait=True returns the rowcount after commit (read-after-write safe);
+        wait=False is fire-and-forget, failures are logged.
+        """
+        fut = self.submit(sql, params, name or _caller())
+        if wait:
+            return await fut
+        fut.add_done_callback(_log_write_failure)
+        return None
+
+    async def execute_returning(self, sql: str, params: tuple | dict = (), name: str | None = None) -> list:
+        """Queued write with a RETURNING clause; resolves to its rows after commit."""
+        if self._writer_task is None:
+            raise RuntimeError("DB pool is not open")
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, fut, name or _caller(), time.perf_counter(), True))
+        return await fut
+
+    async def _writer_loop(self):
+        stop = False
+        while not stop:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            if self.batch_delay:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_max and not self._queue.empty():
+                nxt = self._queue.get_nowait()
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            await self._run_batch(batch)
+        # drain anything queued after the sentinel
+        rest = []
+        while not self._queue.empty():
+            nxt = self._queue.get_nowait()
+            if nxt is not None:
+                rest.append(nxt)
+        if rest:
+            await self._run_batch(rest)
+
+    async def _run_batch(self, batch: list):
+        results: list = []
+        try:
+            async with self._write_lock:
+                db = self._writer
+                await db.execute("BEGIN IMMEDIATE")
+                try:
+                    for sql, params, _, name, _, returning in batch:
+                        await db.execute("SAVEPOINT w")
+                        t0 = time.perf_counter()
+                        try:
+                            cur = await db.execute(sql, params)
+                            results.append(await cur.fetchall() if returning else cur.rowcount)
+                            await db.execute("RELEASE w")
+                        except sqlite3.Error as e:
+                            results.append(e)
+                            metrics.inc("bot_db_errors_total", query=name)
+                            await db.execute("ROLLBACK TO w")
+                            await db.execute("RELEASE w")
+                        metrics.observe("bot_db_query_seconds", time.perf_counter() - t0, query=name, kind="write")
+                    await db.execute("COMMIT")
+                except BaseException:
+                    await db.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            log.exception("DB write batch failed (%s statements)", len(batch))
+            results = [e] * len(batch)
+
+        done = time.perf_counter()
+        for (_, _, fut, _, queued, _), res in zip(batch, results):
+            metrics.observe("bot_db_write_wait_seconds", done - queued)
+            if fut.done():
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+
+def _log_write_failure(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        log.error("Background DB write failed: %r", fut.exception())
+
+
+db_pool = DBPool(DB_PATH, readers=DB_READERS, batch_ms=DB_BATCH_MS, batch_max=DB_BATCH_MAX)
+
+
+# =========================
+# SCHEMA / MIGRATIONS
+# append-only list: (version, name, steps). Each version runs once, in its own
+# transaction, and is recorded in schema_version. A step is SQL or an async fn(db).
+# Never edit a shipped migration — add a new one.
+# =========================
+async def _add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, decl: str):
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in await cur.fetchall()}:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# each year's counter starts at the end of the first run of taken numbers
+# (0 with no tickets, N after N sequential ones): legacy random ids higher up
+# are skipped one by one by create_ticket instead of pushing the counter past them
+_TICKET_SEQ_SEED = """
+    WITH ids AS (
+        SELECT CAST(substr(ticket_id, 4, 4) AS INTEGER) AS year, CAST(substr(ticket_id, 9) AS INTEGER) AS n
+        FROM tickets
+        WHERE ticket_id GLOB 'DD-[0-9][0-9][0-9][0-9]-[0-9]*'
+    ),
+    candidates AS (
+        SELECT DISTINCT year, 1 AS n FROM ids
+        UNION SELECT year, n + 1 FROM ids
+    )
+    INSERT INTO ticket_seq (year, last)
+    SELECT year, MIN(n) - 1 FROM candidates c
+    WHERE NOT EXISTS (SELECT 1 FROM tickets WHERE ticket_id = printf('DD-%04d-%06d', c.year, c.n))
+    GROUP BY year
+    ON CONFLICT(year) DO UPDATE SET last = excluded.last
+"""
+
+MIGRATIONS = [
+    (1, "base tables", (
+        """
         CREATE TABLE IF NOT EXISTS clients (
             tg_id INTEGER PRIMARY KEY,
             phone TEXT,
@@ -286,14 +978,8 @@ async def init_db():
             lang TEXT,
             created_at TEXT
         )
-        """)
-        # migration: add lang if missing
-        try:
-            await db.execute("ALTER TABLE clients ADD COLUMN lang TEXT")
-        except Exception:
-            pass
-
-        await db.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS tickets (
             ticket_id TEXT PRIMARY KEY,
             client_tg_id INTEGER,
@@ -303,8 +989,8 @@ async def init_db():
             created_at TEXT,
             updated_at TEXT
         )
-        """)
-        await db.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ticket_id TEXT,
@@ -312,13 +998,280 @@ async def init_db():
             text TEXT,
             created_at TEXT
         )
+        """,
+    )),
+    # databases created before clients.lang existed
+    (2, "clients.lang", (
+        lambda db: _add_column_if_missing(db, "clients", "lang", "TEXT"),
+    )),
+    (3, "ticket/message indexes", (
+        # get_open_ticket_by_client
+        "CREATE INDEX IF NOT EXISTS idx_tickets_client_status ON tickets(client_tg_id, status, updated_at)",
+        # admin lists by status
+        "CREATE INDEX IF NOT EXISTS idx_tickets_status_updated ON tickets(status, updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_ticket_created ON messages(ticket_id, created_at)",
+        "ANALYZE",
+    )),
+    (4, "fsm storage", (
+        """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,       -- json
+            updated_at REAL  -- unix time
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated_at)",
+    )),
+    (5, "operator sessions", (
+        """
+        CREATE TABLE IF NOT EXISTS operator_sessions (
+            operator_id INTEGER PRIMARY KEY,
+            ticket_id TEXT,
+            updated_at REAL  -- unix time
+        )
+        """,
+    )),
+    # per-year counter behind DD-YYYY-NNNNNN
+    (6, "ticket id sequence", (
+        """
+        CREATE TABLE IF NOT EXISTS ticket_seq (
+            year INTEGER PRIMARY KEY,
+            last INTEGER NOT NULL
+        )
+        """,
+        _TICKET_SEQ_SEED,
+    )),
+    # keyset pagination in the admin browser orders by (updated_at, ticket_id)
+    (7, "admin browser index", (
+        "CREATE INDEX IF NOT EXISTS idx_tickets_status_updated_id ON tickets(status, updated_at, ticket_id)",
+        "DROP INDEX IF EXISTS idx_tickets_status_updated",
+    )),
+    # full-text search for /find. External-content FTS5 tables kept in sync by
+    # triggers, so log_message/upsert_client update the index in their own transaction.
+    # clients use trigram so partial phone numbers and surnames match.
+    (8, "full-text search", (
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+        END
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(
+            name, surname, phone, content='clients', content_rowid='tg_id', tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS clients_fts_ai AFTER INSERT ON clients BEGIN
+            INSERT INTO clients_fts(rowid, name, surname, phone) VALUES (new.tg_id, new.name, new.surname, new.phone);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS clients_fts_ad AFTER DELETE ON clients BEGIN
+            INSERT INTO clients_fts(clients_fts, rowid, name, surname, phone)
+            VALUES ('delete', old.tg_id, old.name, old.surname, old.phone);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS clients_fts_au AFTER UPDATE OF name, surname, phone ON clients BEGIN
+            INSERT INTO clients_fts(clients_fts, rowid, name, surname, phone)
+            VALUES ('delete', old.tg_id, old.name, old.surname, old.phone);
+            INSERT INTO clients_fts(rowid, name, surname, phone) VALUES (new.tg_id, new.name, new.surname, new.phone);
+        END
+        """,
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+        "INSERT INTO clients_fts(clients_fts) VALUES ('rebuild')",
+    )),
+    # lifecycle scheduler: last reminder sent to the assigned operator
+    (9, "ticket reminders", (
+        lambda db: _add_column_if_missing(db, "tickets", "reminded_at", "TEXT"),
+    )),
+    # non-text messages: content type + Telegram file_id (text keeps the caption)
+    (10, "message media", (
+        lambda db: _add_column_if_missing(db, "messages", "media_type", "TEXT"),
+        lambda db: _add_column_if_missing(db, "messages", "file_id", "TEXT"),
+    )),
+    # ticket state machine audit log, written by triggers so every status/assignee
+    # change lands in the same statement as the change itself. tickets.updated_by
+    # carries the actor (NULL = the bot itself, e.g. auto-close).
+    (11, "ticket events", (
+        lambda db: _add_column_if_missing(db, "tickets", "updated_by", "INTEGER"),
+        """
+        CREATE TABLE IF NOT EXISTS ticket_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id TEXT NOT NULL,
+            from_status TEXT,  -- NULL on creation
+            to_status TEXT NOT NULL,
+            operator_id INTEGER,  -- assignee after the change
+            actor_id INTEGER,
+            created_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ticket_events_ticket ON ticket_events(ticket_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_ticket_events_created ON ticket_events(created_at)",
+        """
+        CREATE TRIGGER IF NOT EXISTS ticket_events_ai AFTER INSERT ON tickets BEGIN
+            INSERT INTO ticket_events (ticket_id, from_status, to_status, operator_id, actor_id, created_at)
+            VALUES (new.ticket_id, NULL, new.status, new.assigned_operator_id, new.updated_by, new.created_at);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS ticket_events_au AFTER UPDATE OF status, assigned_operator_id ON tickets
+        WHEN old.status IS NOT new.status OR old.assigned_operator_id IS NOT new.assigned_operator_id BEGIN
+            INSERT INTO ticket_events (ticket_id, from_status, to_status, operator_id, actor_id, created_at)
+            VALUES (new.ticket_id, old.status, new.status, new.assigned_operator_id, new.updated_by, new.updated_at);
+        END
+        """,
+        # history before this migration: only the creation is known
+        """
+        INSERT INTO ticket_events (ticket_id, from_status, to_status, operator_id, actor_id, created_at)
+        SELECT ticket_id, NULL, 'new', NULL, client_tg_id, created_at FROM tickets
+        WHERE ticket_id NOT IN (SELECT ticket_id FROM ticket_events)
+        """,
+    )),
+    # live ticket card in the operators group (edited in place)
+    (12, "ticket cards", (
+        lambda db: _add_column_if_missing(db, "tickets", "card_message_id", "INTEGER"),
+    )),
+    # v6 used to seed past the highest legacy random id (~999k), so ids went 7-digit
+    # after a few thousand tickets. Restart low; create_ticket skips taken numbers.
+    (13, "ticket id sequence reseed", (
+        _TICKET_SEQ_SEED,
+    )),
+]
+
+
+async def get_schema_version() -> int:
+    async with db_pool.write() as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TEXT
+            )
         """)
-        await db.commit()
+        cur = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return (await cur.fetchone())[0]
+
+
+async def init_db():
+    current = await get_schema_version()
+    latest = MIGRATIONS[-1][0]
+    if current > latest:
+        raise RuntimeError(f"DB schema v{current} is newer than this bot (knows up to v{latest})")
+
+    for version, name, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        log.info("Applying DB migration v%s: %s", version, name)
+        async with db_pool.write() as db:
+            for step in steps:
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.now(UTC).isoformat())
+            )
+    if current < latest:
+        log.info("DB schema at v%s", latest)
+
+
+# =========================
+# CLIENT CACHE
+# tg_id -> clients row (or None for unknown users), LRU + TTL.
+# upsert_client writes through, so a hit is never staler than our own writes.
+# =========================
+CLIENT_CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", "10000").strip() or "10000")
+CLIENT_CACHE_TTL = float(os.getenv("CLIENT_CACHE_TTL", "600").strip() or "600")
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=_MISSING):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def setdefault(self, key, value):
+        """Store value unless a live entry is already there; returns whichever is cached."""
+        item = self._data.get(key)
+        if item is not None and item[0] >= time.monotonic():
+            return item[1]
+        self.set(key, value)
+        return value
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+client_cache = TTLCache(CLIENT_CACHE_SIZE, CLIENT_CACHE_TTL)
+
+_CLIENT_SQL = "SELECT tg_id, phone, surname, name, lang FROM clients WHERE tg_id=?"
+
 
 async def get_client(tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT tg_id, phone, surname, name, lang FROM clients WHERE tg_id=?", (tg_id,))
-        return await cur.fetchone()
+    c = client_cache.get(tg_id)
+    if c is not _MISSING:
+        return c
+    c = await db_pool.fetchone(_CLIENT_SQL, (tg_id,))
+    # an upsert_client that finished during the read cached a newer row: keep that one
+    return client_cache.setdefault(tg_id, c)
 
 async def get_lang(user_id: int) -> str:
     c = await get_client(user_id)
@@ -328,81 +1281,401 @@ async def get_lang(user_id: int) -> str:
 
 async def upsert_client(tg_id: int, phone: str | None, surname: str | None, name: str | None, lang: str | None):
     now = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT tg_id FROM clients WHERE tg_id=?", (tg_id,))
-        existing = await cur.fetchone()
+    try:
+        async with db_pool.write() as db:
+            cur = await db.execute("SELECT tg_id FROM clients WHERE tg_id=?", (tg_id,))
+            existing = await cur.fetchone()
+
+            if existing:
+                await db.execute(
+                    "UPDATE clients SET phone=COALESCE(?, phone), surname=COALESCE(?, surname), name=COALESCE(?, name), lang=COALESCE(?, lang) WHERE tg_id=?",
+                    (phone, surname, name, lang, tg_id)
+                )
+            else:
+                await db.execute(
+                    "INSERT INTO clients (tg_id, phone, surname, name, lang, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (tg_id, phone, surname, name, lang, now)
+                )
+            cur = await db.execute(_CLIENT_SQL, (tg_id,))
+            row = await cur.fetchone()
+    except Exception:
+        client_cache.pop(tg_id)
+        raise
+    client_cache.set(tg_id, row)
+
+# =========================
+# OPEN TICKET INDEX
+# client_tg_id -> newest open ticket, built from the DB at startup and kept in
+# sync by create_ticket and the ticket state machine (transition()). Routing a client
+# message is a dict lookup instead of two queries.
+# =========================
+class OpenTicket(NamedTuple):
+    ticket_id: str
+    status: str
+    assigned_operator_id: int | None
+    service: str
+
+
+_OPEN_TICKETS_SQL = """
+    SELECT client_tg_id, ticket_id, status, assigned_operator_id, service
+    FROM tickets
+    WHERE status IN ('new','in_progress')
+    ORDER BY updated_at ASC
+"""
+
+
+class OpenTicketIndex:
+    def __init__(self):
+        self.by_client: dict[int, OpenTicket] = {}
+        self.by_ticket: dict[str, int] = {}  # ticket_id -> client_tg_id
+
+    @staticmethod
+    def _build(rows) -> dict[int, OpenTicket]:
+        # rows come oldest first, so the newest open ticket per client wins
+        return {r[0]: OpenTicket(r[1], r[2], r[3], r[4]) for r in rows}
+
+    async def load(self):
+        self.by_client = self._build(await db_pool.fetchall(_OPEN_TICKETS_SQL))
+        self.by_ticket = {t.ticket_id: cid for cid, t in self.by_client.items()}
+        log.info("Open ticket index loaded: %s tickets", len(self.by_client))
+
+    def get(self, client_tg_id: int) -> OpenTicket | None:
+        return self.by_client.get(client_tg_id)
+
+    def put(self, client_tg_id: int, ticket: OpenTicket):
+        old = self.by_client.get(client_tg_id)
+        if old is not None:
+            self.by_ticket.pop(old.ticket_id, None)
+        self.by_client[client_tg_id] = ticket
+        self.by_ticket[ticket.ticket_id] = client_tg_id
+
+    def update(self, ticket_id: str, **fields):
+        cid = self.by_ticket.get(ticket_id)
+        if cid is not None:
+            self.by_client[cid] = self.by_client[cid]._replace(**fields)
+
+    def remove(self, ticket_id: str):
+        cid = self.by_ticket.pop(ticket_id, None)
+        t = self.by_client.get(cid) if cid is not None else None
+        if t is not None and t.ticket_id == ticket_id:
+            del self.by_client[cid]
+
+    async def check(self, repair: bool = False) -> list[str]:
+        """Compare the index with SQLite; returns human-readable differences."""
+        rows = await db_pool.fetchall(_OPEN_TICKETS_SQL)
+        actual = self._build(rows)
+        diffs = []
+        # the index keeps one ticket per client: more open ones in the DB can't be repaired here
+        per_client: dict[int, list[str]] = {}
+        for r in rows:
+            per_client.setdefault(r[0], []).append(r[1])
+        for cid, ids in sorted(per_client.items()):
+            if len(ids) > 1:
+                diffs.append(f"{cid}: {len(ids)} open tickets in db ({', '.join(ids)})")
+        for cid in sorted(actual.keys() | self.by_client.keys()):
+            want, have = actual.get(cid), self.by_client.get(cid)
+            if want != have:
+                diffs.append(f"{cid}: db={tuple(want) if want else None} index={tuple(have) if have else None}")
+        if diffs and repair:
+            self.by_client = actual
+            self.by_ticket = {t.ticket_id: cid for cid, t in actual.items()}
+        return diffs
+
+
+open_tickets = OpenTicketIndex()
 
-        if existing:
-            await db.execute(
-                "UPDATE clients SET phone=COALESCE(?, phone), surname=COALESCE(?, surname), name=COALESCE(?, name), lang=COALESCE(?, lang) WHERE tg_id=?",
-                (phone, surname, name, lang, tg_id)
-            )
-        else:
-            await db.execute(
-                "INSERT INTO clients (tg_id, phone, surname, name, lang, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (tg_id, phone, surname, name, lang, now)
-            )
-        await db.commit()
 
 async def create_ticket(client_tg_id: int, service: str) -> str:
-    ticket_id = gen_ticket_id()
-    now = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+    now_dt = datetime.now(UTC)
+    now = now_dt.isoformat()
+    # the counter bump and the insert share one transaction on the single writer,
+    # so concurrent handlers get distinct ids and a failed insert doesn't burn one
+    async with db_pool.write() as db:
+        while True:
+            cur = await db.execute("""
+                INSERT INTO ticket_seq (year, last) VALUES (?, 1)
+                ON CONFLICT(year) DO UPDATE SET last = last + 1
+                RETURNING last
+            """, (now_dt.year,))
+            seq = (await cur.fetchone())[0]
+            await cur.close()
+            if seq > TICKET_SEQ_MAX:
+                # raising rolls the bump back, so the counter stays at the cap
+                raise RuntimeError(f"ticket ids for {now_dt.year} exhausted: DD-{now_dt.year}-{TICKET_SEQ_MAX} already issued")
+            ticket_id = format_ticket_id(now_dt.year, seq)
+            # legacy random ids are scattered over the range: step over the rare one we hit
+            cur = await db.execute("SELECT 1 FROM tickets WHERE ticket_id=?", (ticket_id,))
+            taken = await cur.fetchone()
+            await cur.close()
+            if taken is None:
+                break
         await db.execute("""
-            INSERT INTO tickets (ticket_id, client_tg_id, service, status, assigned_operator_id, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (ticket_id, client_tg_id, service, "new", None, now, now))
-        await db.commit()
+            INSERT INTO tickets (ticket_id, client_tg_id, service, status, assigned_operator_id, created_at, updated_at, updated_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (ticket_id, client_tg_id, service, "new", None, now, now, client_tg_id))
+    open_tickets.put(client_tg_id, OpenTicket(ticket_id, "new", None, service))
     return ticket_id
 
 async def get_ticket(ticket_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT ticket_id, client_tg_id, service, status, assigned_operator_id
-            FROM tickets WHERE ticket_id=?
-        """, (ticket_id,))
-        return await cur.fetchone()
-
-async def get_open_ticket_by_client(client_tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT ticket_id, service, status
-            FROM tickets
-            WHERE client_tg_id=? AND status IN ('new','in_progress')
-            ORDER BY updated_at DESC LIMIT 1
-        """, (client_tg_id,))
-        return await cur.fetchone()
-
-async def set_ticket_status(ticket_id: str, status: str):
-    now = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE tickets SET status=?, updated_at=? WHERE ticket_id=?", (status, now, ticket_id))
-        await db.commit()
+    return await db_pool.fetchone("""
+        SELECT ticket_id, client_tg_id, service, status, assigned_operator_id
+        FROM tickets WHERE ticket_id=?
+    """, (ticket_id,))
 
-async def assign_ticket(ticket_id: str, operator_id: int):
-    now = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        # allow claim if NULL only
-        await db.execute("""
-            UPDATE tickets
-            SET assigned_operator_id=?, status='in_progress', updated_at=?
-            WHERE ticket_id=? AND assigned_operator_id IS NULL
-        """, (operator_id, now, ticket_id))
-        await db.commit()
+async def get_open_ticket_by_client(client_tg_id: int) -> OpenTicket | None:
+    return open_tickets.get(client_tg_id)
 
-async def log_message(ticket_id: str, from_role: str, text: str):
+async def log_message(ticket_id: str, from_role: str, text: str,
+                      media_type: str | None = None, file_id: str | None = None):
     now = datetime.now(UTC).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO messages (ticket_id, from_role, text, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (ticket_id, from_role, text, now))
-        await db.commit()
+    # nobody reads the log back within the same update, so don't wait for the commit
+    await db_pool.execute("""
+        INSERT INTO messages (ticket_id, from_role, text, created_at, media_type, file_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (ticket_id, from_role, text, now, media_type, file_id), wait=False)
+
+def iter_history(ticket_id: str):
+    """(id, from_role, text, created_at, media_type, file_id) rows of one ticket, oldest first, streamed from a cursor."""
+    return db_pool.stream("""
+        SELECT id, from_role, text, created_at, media_type, file_id
+        FROM messages WHERE ticket_id=?
+        ORDER BY created_at, id
+    """, (ticket_id,), name="iter_history")
+
+def utf16_len(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units: emoji outside the BMP count 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _split_utf16(text: str, room: int):
+    """Pieces of `text` of at most `room` UTF-16 units, never splitting a surrogate pair."""
+    start = size = 0
+    for i, ch in enumerate(text):
+        w = 2 if ord(ch) > 0xFFFF else 1
+        if size + w > room:
+            yield text[start:i]
+            start, size = i, 0
+        size += w
+    yield text[start:]
+
+async def history_chunks(rows, limit: int = 4000):
+    """
+    Group history rows into HTML message bodies of at most `limit` visible UTF-16 units
+    (Telegram counts the text after entity parsing, so tags and escapes are free).
+    A single message longer than the limit is split across chunks.
+    """
+    lines: list[str] = []
+    size = 0
+    async for _, role, text, created_at, media_type, _ in rows:
+        head = f"[{(created_at or '')[:16].replace('T', ' ')}] {'👤' if role == 'client' else '🧑‍💼'} "
+        if media_type:
+            head += f"📎 {media_type} "
+        head_len = utf16_len(head)
+        for piece in _split_utf16(text or "", max(2, limit - head_len - 1)):
+            piece_len = head_len + utf16_len(piece) + 1
+            if lines and size + piece_len > limit:
+                yield "\n".join(lines)
+                lines, size = [], 0
+            lines.append(f"<b>{html.escape(head)}</b>{html.escape(piece)}")
+            size += piece_len
+    if lines:
+        yield "\n".join(lines)
+
+class TicketFilter(NamedTuple):
+    status: str
+    service: str | None = None
+    operator_id: int | None = None  # 0 = unassigned
+    date_from: str | None = None    # YYYY-MM-DD, on updated_at, inclusive
+    date_to: str | None = None      # YYYY-MM-DD, inclusive
+
+
+async def list_tickets_page(f: TicketFilter, limit: int, after: tuple[str, str] | None = None):
+    """
+    One page of tickets, newest first. Keyset pagination: `after` is the
+    (updated_at, ticket_id) of the previous page's last row, so every page is an
+    index range scan on (status, updated_at, ticket_id) no matter how deep it is.
+    """
+    where, params = ["status=?"], [f.status]
+    if f.service:
+        where.append("service=?")
+        params.append(f.service)
+    if f.operator_id == 0:
+        where.append("assigned_operator_id IS NULL")
+    elif f.operator_id:
+        where.append("assigned_operator_id=?")
+        params.append(f.operator_id)
+    if f.date_from:
+        where.append("updated_at >= ?")
+        params.append(f.date_from)
+    if f.date_to:
+        where.append("updated_at < date(?, '+1 day')")
+        params.append(f.date_to)
+    if after:
+        where.append("(updated_at, ticket_id) < (?, ?)")
+        params.extend(after)
+    params.append(limit)
+    return await db_pool.fetchall(f"""
+        SELECT ticket_id, service, status, updated_at, assigned_operator_id
+        FROM tickets WHERE {" AND ".join(where)}
+        ORDER BY updated_at DESC, ticket_id DESC LIMIT ?
+    """, tuple(params))
+
+
+def _snippet(text: str, pattern: re.Pattern, width: int = 70) -> str:
+    m = pattern.search(text)
+    start = max(0, (m.start() if m else 0) - width // 3)
+    part = text[start:start + width]
+    part = pattern.sub(lambda x: f"\x02{x.group(0)}\x03", part)
+    return ("…" if start else "") + part + ("…" if start + width < len(text) else "")
+
+
+def _fts_terms(query: str, min_len: int = 1) -> list[str]:
+    # every user word becomes a quoted phrase, so FTS5 operators in the input are inert
+    return ['"' + w.replace('"', '""') + '"' for w in query.split() if len(w) >= min_len]
+
+
+# Ranking (bm25) every match of a very common word costs ~0.5 s at 1M messages,
+# so message hits are ranked within the SEARCH_WINDOW newest matching messages:
+# the cutoff rowid is found by walking the doclist backwards, which is cheap.
+SEARCH_WINDOW = int(os.getenv("SEARCH_WINDOW", "1000").strip() or "1000")
+
+_SEARCH_SQL = """
+    WITH hits AS (
+        SELECT * FROM (
+            SELECT m.ticket_id AS ticket_id, f.rank AS score, f.rowid AS msg_id
+            FROM messages_fts f JOIN messages m ON m.id = f.rowid
+            WHERE messages_fts MATCH :mq
+              AND f.rowid > COALESCE((
+                  SELECT rowid FROM messages_fts WHERE messages_fts MATCH :mq
+                  ORDER BY rowid DESC LIMIT 1 OFFSET :window
+              ), 0)
+            ORDER BY f.rank LIMIT :cap
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT t.ticket_id, c.rank, NULL
+            FROM clients_fts c JOIN tickets t ON t.client_tg_id = c.rowid
+            WHERE :cq IS NOT NULL AND clients_fts MATCH :cq
+            ORDER BY c.rank LIMIT :cap
+        )
+    )
+    SELECT h.ticket_id, t.status, t.service, cl.name, cl.surname, h.msg_id, MIN(h.score) AS best
+    FROM hits h
+    JOIN tickets t ON t.ticket_id = h.ticket_id
+    LEFT JOIN clients cl ON cl.tg_id = t.client_tg_id
+    GROUP BY h.ticket_id
+    ORDER BY best
+    LIMIT :lim
+"""
+
+
+async def search_tickets(query: str, limit: int = 10):
+    """
+    Ranked tickets for a free-text query: conversation text (word prefixes) and
+    client name/surname/phone (substrings of 3+ chars). Returns
+    (ticket_id, status, service, name, surname, snippet) — snippet marks hits with \\x02/\\x03.
+    """
+    terms = _fts_terms(query)
+    if not terms:
+        return []
+    client_terms = _fts_terms(query, min_len=3)
+    mq = " ".join(t + "*" for t in terms)
+    rows = await db_pool.fetchall(_SEARCH_SQL, {
+        "mq": mq,
+        "cq": " ".join(client_terms) if client_terms else None,
+        "window": SEARCH_WINDOW,
+        "cap": 500,
+        "lim": limit,
+    })
+    # snippets only for the messages that made the cut; FTS5 snippet() with a
+    # rowid IN (...) filter re-walks the whole doclist, PK lookups + re are far cheaper
+    msg_ids = [r[5] for r in rows if r[5] is not None]
+    snippets = {}
+    if msg_ids:
+        texts = await db_pool.fetchall(
+            f"SELECT id, text FROM messages WHERE id IN ({','.join('?' * len(msg_ids))})", tuple(msg_ids)
+        )
+        pattern = re.compile(r"\b(?:" + "|".join(re.escape(w) for w in query.split()) + r")\w*", re.IGNORECASE)
+        snippets = {mid: _snippet(text or "", pattern) for mid, text in texts}
+    return [(*r[:5], snippets.get(r[5])) for r in rows]
+
+
+# =========================
+# TICKET STATE MACHINE
+# new -> in_progress (claim) -> closed (close), closed -> new/in_progress (reopen,
+# keeps the operator). Each transition is one guarded UPDATE ... RETURNING on the
+# batching writer: it only matches a ticket in an allowed state, so check and change
+# can't interleave with another operator or the lifecycle sweep, and the
+# ticket_events trigger logs it in the same statement.
+# =========================
+TICKET_TRANSITIONS = {
+    # event: (allowed source statuses, SET clause, extra WHERE condition)
+    "claim": (("new",), "status='in_progress', assigned_operator_id=:actor", ""),
+    "close": (("new", "in_progress"), "status='closed'", ""),
+    # a client has at most one open ticket: routing and the index rely on it
+    "reopen": (("closed",), "status=CASE WHEN assigned_operator_id IS NULL THEN 'new' ELSE 'in_progress' END, "
+                            "reminded_at=NULL",
+               "NOT EXISTS (SELECT 1 FROM tickets o WHERE o.client_tg_id = tickets.client_tg_id "
+               "AND o.status IN ('new','in_progress'))"),
+}
+
+_TICKET_COLUMNS = "ticket_id, client_tg_id, service, status, assigned_operator_id"
+
+
+class TransitionResult(NamedTuple):
+    ok: bool
+    reason: str | None  # None | "not_found" | "state" | "assigned_other" | "client_has_open" | "guard"
+    ticket: tuple | None  # get_ticket() row: after the change on success, as found otherwise
+
+
+async def transition(ticket_id: str, event: str, actor_id: int | None, guard: str = "",
+                     **guard_params) -> TransitionResult:
+    """
+    Apply `event` to a ticket in one round-trip. An operator (actor_id) may only
+    act on tickets that are unassigned or their own; actor_id=None is the bot.
+    `guard` is an extra WHERE condition using its own :named params.
+    """
+    sources, assign, where = TICKET_TRANSITIONS[event]
+    sql = f"""
+        UPDATE tickets SET {assign}, updated_at=:now, updated_by=:actor
+        WHERE ticket_id=:ticket AND status IN ({", ".join(f"'{s}'" for s in sources)})
+          AND (:actor IS NULL OR assigned_operator_id IS NULL OR assigned_operator_id=:actor)
+          {f"AND {where}" if where else ""}
+          {f"AND ({guard})" if guard else ""}
+        RETURNING {_TICKET_COLUMNS}
+    """
+    params = {"now": datetime.now(UTC).isoformat(), "actor": actor_id, "ticket": ticket_id, **guard_params}
+    rows = await db_pool.execute_returning(sql, params, name=f"ticket_{event}")
+    if rows:
+        t = tuple(rows[0])
+        if t[3] == "closed":
+            open_tickets.remove(ticket_id)
+        elif event == "reopen":
+            open_tickets.put(t[1], OpenTicket(t[0], t[3], t[4], t[2]))
+        else:
+            open_tickets.update(ticket_id, status=t[3], assigned_operator_id=t[4])
+        ticket_cards.touch(ticket_id)
+        return TransitionResult(True, None, t)
+
+    # lost the race or not allowed: read once to tell the caller why
+    t = await get_ticket(ticket_id)
+    if t is None:
+        return TransitionResult(False, "not_found", None)
+    if actor_id is not None and t[4] not in (None, actor_id):
+        return TransitionResult(False, "assigned_other", t)
+    if t[3] not in sources:
+        return TransitionResult(False, "state", t)
+    if event == "reopen" and open_tickets.get(t[1]):
+        return TransitionResult(False, "client_has_open", t)
+    return TransitionResult(False, "guard", t)
 
 
 # =========================
 # KEYBOARDS
+# Keyboards depend only on (lang, service_key) — or the ticket id — so each variant
+# is built once and the same instance is reused: never mutate a returned markup.
+# warm_keyboards() prebuilds the static ones at startup.
 # =========================
+@lru_cache(maxsize=1)
 def kb_lang():
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -411,20 +1684,25 @@ def kb_lang():
         ]
     ])
 
+@lru_cache(maxsize=8)
 def kb_share_phone(lang: str):
     return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=T[lang]["btn_share_phone"], request_contact=True)]],
+        keyboard=[[KeyboardButton(text=tr(lang, "btn_share_phone"), request_contact=True)]],
         resize_keyboard=True,
         one_time_keyboard=True
     )
 
+# built from services.current; ServiceCatalogStore resets it on every swap
+@lru_cache(maxsize=8)
 def kb_main_menu(lang: str):
     rows = []
-    for key, label in SERVICE_KEYS:
+    for key, label in services.current.service_keys:
         rows.append([InlineKeyboardButton(text=label, callback_data=f"svc:{key}")])
     rows.append([InlineKeyboardButton(text=tr(lang, "talk_to_operator"), callback_data="op:choose")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+# service_key comes from callback data, hence the bound
+@lru_cache(maxsize=128)
 def kb_service(lang: str, service_key: str):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=tr(lang, "docs_btn"), callback_data=f"info:{service_key}:docs")],
@@ -434,6 +1712,7 @@ def kb_service(lang: str, service_key: str):
         [InlineKeyboardButton(text=tr(lang, "back_btn"), callback_data="back:menu")],
     ])
 
+@lru_cache(maxsize=8)
 def kb_operator_choice(lang: str):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=tr(lang, "wa_recommended"), callback_data="op:wa")],
@@ -441,24 +1720,1154 @@ def kb_operator_choice(lang: str):
         [InlineKeyboardButton(text=tr(lang, "back"), callback_data="back:menu")],
     ])
 
+@lru_cache(maxsize=8)
+def kb_admin(lang: str):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=tr(lang, "admin_new"), callback_data="adm:list:new")],
+        [InlineKeyboardButton(text=tr(lang, "admin_progress"), callback_data="adm:list:in_progress")],
+        [InlineKeyboardButton(text=tr(lang, "admin_closed"), callback_data="adm:list:closed")],
+        [InlineKeyboardButton(text=tr(lang, "admin_search"), callback_data="adm:search:ask")],
+        [InlineKeyboardButton(text=tr(lang, "admin_reload_catalog"), callback_data="adm:catalog:reload")],
+    ])
+
+@lru_cache(maxsize=8)
+def _ticket_actions_texts(lang: str) -> tuple[str, str, str]:
+    return tr(lang, "claim_btn"), tr(lang, "reply_btn"), tr(lang, "close_btn")
+
+# per-ticket callback data: a small LRU, since the same ticket's buttons are sent
+# again on every client message; texts come from the per-language template
+@lru_cache(maxsize=512)
 def kb_ticket_actions(lang: str, ticket_id: str):
+    claim, reply, close = _ticket_actions_texts(lang)
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text=tr(lang, "claim_btn"), callback_data=f"t:claim:{ticket_id}"),
-            InlineKeyboardButton(text=tr(lang, "reply_btn"), callback_data=f"t:reply:{ticket_id}")
+            InlineKeyboardButton(text=claim, callback_data=f"t:claim:{ticket_id}"),
+            InlineKeyboardButton(text=reply, callback_data=f"t:reply:{ticket_id}")
         ],
-        [InlineKeyboardButton(text=tr(lang, "close_btn"), callback_data=f"t:close:{ticket_id}")]
+        [InlineKeyboardButton(text=close, callback_data=f"t:close:{ticket_id}")]
     ])
 
+_KEYBOARD_CACHES = (
+    kb_lang, kb_share_phone, kb_main_menu, kb_service, kb_operator_choice, kb_admin,
+    _ticket_actions_texts, kb_ticket_actions,
+)
+
+def reset_keyboards():
+    for fn in _KEYBOARD_CACHES:
+        fn.cache_clear()
+
+def warm_keyboards():
+    kb_lang()
+    for lang in T:
+        kb_share_phone(lang)
+        kb_main_menu(lang)
+        kb_operator_choice(lang)
+        kb_admin(lang)
+        _ticket_actions_texts(lang)
+        for key, _ in services.current.service_keys:
+            kb_service(lang, key)
+
+
+# =========================
+# FSM STORAGE (SQLite, write-behind)
+# Reads are served from an in-memory cache of recently used keys; writes only mark
+# the key dirty and are flushed to the fsm table in one transaction every
+# FSM_FLUSH_SEC. Keys idle for FSM_TTL_HOURS expire (abandoned registrations etc.).
+# =========================
+FSM_FLUSH_SEC = float(os.getenv("FSM_FLUSH_SEC", "1").strip() or "1")
+FSM_TTL_HOURS = float(os.getenv("FSM_TTL_HOURS", "72").strip() or "72")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000").strip() or "5000")
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, pool: DBPool, flush_sec: float = 1, ttl_hours: float = 72, cache_size: int = 5000):
+        self.pool = pool
+        self.flush_sec = flush_sec
+        self.ttl = ttl_hours * 3600
+        self.cache_size = max(1, cache_size)
+        self._cache: OrderedDict[str, list] = OrderedDict()  # key -> [state, data, updated_at]
+        self._dirty: set[str] = set()
+        self._task: asyncio.Task | None = None
+        self._last_expire = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _entry(self, k: str) -> list:
+        entry = self._cache.get(k)
+        if entry is not None:
+            self._cache.move_to_end(k)
+        else:
+            row = await self.pool.fetchone("SELECT state, data, updated_at FROM fsm WHERE key=?", (k,))
+            # another update of the same key may have loaded (and changed) it meanwhile: theirs wins
+            entry = self._cache.get(k)
+            if entry is not None:
+                self._cache.move_to_end(k)
+                return entry
+            if row and row[2] >= time.time() - self.ttl:
+                entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                entry = [None, {}, time.time()]
+            self._evict(reserve=1)
+            self._cache[k] = entry
+        return entry
+
+    def _touch(self, k: str, entry: list):
+        entry[2] = time.time()
+        self._dirty.add(k)
+
+    def _evict(self, reserve: int = 0):
+        # only clean entries can go; dirty ones leave after the next flush
+        limit = self.cache_size - reserve
+        if len(self._cache) <= limit:
+            return
+        for k in list(self._cache):
+            if len(self._cache) <= limit:
+                break
+            if k not in self._dirty:
+                del self._cache[k]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        entry = await self._entry(k)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(k, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        k = self._key(key)
+        entry = await self._entry(k)
+        entry[1] = data.copy()
+        self._touch(k, entry)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._entry(self._key(key)))[1].copy()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop(), name="fsm-flush")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_sec)
+            try:
+                await self.flush()
+                if time.time() - self._last_expire > 60:
+                    await self.expire()
+            except Exception:
+                log.exception("FSM flush failed")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for k in keys:
+            entry = self._cache.get(k)
+            if entry is None:
+                continue
+            state, data, updated_at = entry
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+        try:
+            async with self.pool.write() as db:
+                if upserts:
+                    await db.executemany("""
+                        INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+                    """, upserts)
+                if deletes:
+                    await db.executemany("DELETE FROM fsm WHERE key=?", deletes)
+        except Exception:
+            self._dirty |= keys  # retry next round
+            raise
+        self._evict()
+
+    async def expire(self):
+        self._last_expire = time.time()
+        cutoff = time.time() - self.ttl
+        for k in [k for k, e in self._cache.items() if e[2] < cutoff and k not in self._dirty]:
+            del self._cache[k]
+        removed = await self.pool.execute("DELETE FROM fsm WHERE updated_at < ?", (cutoff,))
+        if removed:
+            log.info("FSM: expired %s stale states", removed)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+fsm_storage = SQLiteStorage(db_pool, flush_sec=FSM_FLUSH_SEC, ttl_hours=FSM_TTL_HOURS, cache_size=FSM_CACHE_SIZE)
+
+
+# =========================
+# ACTIVE CHAT (operator -> ticket)
+# operator_id -> ticket_id; dict-like, reads from memory, writes through to
+# operator_sessions so a restart keeps every operator's open conversation.
+# Sessions idle for OPERATOR_SESSION_TTL_HOURS are dropped.
+# =========================
+OPERATOR_SESSION_TTL_HOURS = float(os.getenv("OPERATOR_SESSION_TTL_HOURS", "12").strip() or "12")
+_SESSION_TOUCH_SEC = 60  # don't rewrite the row more often than this for the same ticket
+
+
+class OperatorSessions:
+    def __init__(self, pool: DBPool, ttl_hours: float = 12):
+        self.pool = pool
+        self.ttl = ttl_hours * 3600
+        self._sessions: dict[int, tuple[str, float]] = {}  # operator_id -> (ticket_id, last_used)
+
+    async def load(self):
+        cutoff = time.time() - self.ttl
+        await self.pool.execute("DELETE FROM operator_sessions WHERE updated_at < ?", (cutoff,))
+        rows = await self.pool.fetchall("SELECT operator_id, ticket_id, updated_at FROM operator_sessions")
+        self._sessions = {r[0]: (r[1], r[2]) for r in rows}
+        log.info("Operator sessions loaded: %s", len(self._sessions))
+
+    def _persist(self, sql: str, params: tuple):
+        self.pool.submit(sql, params).add_done_callback(_log_write_failure)
+
+    def get(self, operator_id: int, default=None) -> str | None:
+        item = self._sessions.get(operator_id)
+        if item is None:
+            return default
+        if item[1] < time.time() - self.ttl:
+            self.pop(operator_id)
+            return default
+        return item[0]
+
+    def __contains__(self, operator_id: int) -> bool:
+        return self.get(operator_id) is not None
+
+    def __setitem__(self, operator_id: int, ticket_id: str):
+        now = time.time()
+        old = self._sessions.get(operator_id)
+        self._sessions[operator_id] = (ticket_id, now)
+        if old is not None and old[0] == ticket_id and now - old[1] < _SESSION_TOUCH_SEC:
+            return
+        self._persist("""
+            INSERT INTO operator_sessions (operator_id, ticket_id, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(operator_id) DO UPDATE SET ticket_id=excluded.ticket_id, updated_at=excluded.updated_at
+        """, (operator_id, ticket_id, now))
+
+    def touch(self, operator_id: int):
+        ticket_id = self.get(operator_id)
+        if ticket_id is not None:
+            self[operator_id] = ticket_id
+
+    def pop(self, operator_id: int, default=None) -> str | None:
+        item = self._sessions.pop(operator_id, None)
+        if item is None:
+            return default
+        self._persist("DELETE FROM operator_sessions WHERE operator_id=?", (operator_id,))
+        return item[0]
+
+
+ACTIVE_TICKET = OperatorSessions(db_pool, ttl_hours=OPERATOR_SESSION_TTL_HOURS)
+
 
 # =========================
 # BOT / DISPATCHER
 # =========================
 bot = Bot(
     BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=fsm_storage)
+
+
+# =========================
+# OUTBOX (rate-limited outbound sends)
+# Handlers hand messages off with outbox.send() and return; workers deliver them
+# respecting a global and a per-chat token bucket, keep per-chat order, honour
+# TelegramRetryAfter, retry network/5xx errors with backoff and park permanent
+# failures in a bounded dead-letter list.
+# =========================
+OUT_GLOBAL_RATE = float(os.getenv("OUT_GLOBAL_RATE", "25").strip() or "25")      # msgs/sec, whole bot
+OUT_CHAT_RATE = float(os.getenv("OUT_CHAT_RATE", "1").strip() or "1")            # msgs/sec, private chat
+OUT_GROUP_RATE = float(os.getenv("OUT_GROUP_RATE", "0.33").strip() or "0.33")    # msgs/sec, group (~20/min)
+OUT_WORKERS = int(os.getenv("OUT_WORKERS", "4").strip() or "4")
+OUT_MAX_ATTEMPTS = int(os.getenv("OUT_MAX_ATTEMPTS", "5").strip() or "5")
+OUT_DEAD_LETTERS = 500
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 = take one now)."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while (wait := self.delay()) > 0:
+            await asyncio.sleep(wait)
+        self.take()
+
+
+class _Outgoing:
+    __slots__ = ("chat_id", "method", "future", "attempts", "expected")
+
+    def __init__(self, chat_id: int, method: TelegramMethod, future: asyncio.Future, expected: tuple[str, ...] = ()):
+        self.chat_id = chat_id
+        self.method = method
+        self.future = future
+        self.attempts = 0
+        self.expected = expected
+
+
+class Outbox:
+    def __init__(self, bot: Bot, workers: int = 4, max_attempts: int = 5):
+        self.bot = bot
+        self.workers_count = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.global_bucket = TokenBucket(OUT_GLOBAL_RATE, OUT_GLOBAL_RATE)
+        self._chats: dict[int, deque[_Outgoing]] = {}
+        self._buckets: dict[int, TokenBucket] = {}
+        self._busy: set[int] = set()              # chats queued in _ready or held by a worker
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+        self.dead_letters: deque[tuple[float, int, str, str]] = deque(maxlen=OUT_DEAD_LETTERS)
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            b = TokenBucket(OUT_GROUP_RATE, 5) if chat_id < 0 else TokenBucket(OUT_CHAT_RATE, 3)
+            self._buckets[chat_id] = b
+        return b
+
+    def _schedule(self, chat_id: int, delay: float = 0.0):
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+
+    def call(self, chat_id: int, method: TelegramMethod, expected: tuple[str, ...] = ()) -> asyncio.Future:
+        """
+        Queue any Bot API method addressed to chat_id; the future resolves to its result.
+        A bad request whose description contains one of `expected` is one the caller
+        handles itself: it fails the future but is not a dead letter.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._chats.setdefault(chat_id, deque()).append(_Outgoing(chat_id, method, fut, expected))
+        if chat_id not in self._busy:
+            self._busy.add(chat_id)
+            self._schedule(chat_id)
+        return fut
+
+    def send(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        return self.call(chat_id, SendMessage(chat_id=chat_id, text=text, **kwargs))
+
+    async def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(), name=f"outbox-{i}") for i in range(self.workers_count)]
+
+    async def close(self, timeout: float = 10):
+        """Give queued messages up to `timeout` seconds to go out, then stop the workers."""
+        if not self._workers:
+            return
+        deadline = time.monotonic() + timeout
+        while self._chats and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._chats:
+            log.warning("Outbox closing with %s chats still pending", len(self._chats))
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._drain_chat(chat_id)
+            except Exception:
+                log.exception("Outbox worker error for chat %s", chat_id)
+                self._schedule(chat_id, 1)
+
+    async def _drain_chat(self, chat_id: int):
+        pending = self._chats.get(chat_id)
+        bucket = self._bucket(chat_id)
+        while pending:
+            wait = bucket.delay()
+            if wait > 0:
+                # free the worker; come back when this chat has a token again
+                self._schedule(chat_id, wait)
+                return
+            item = pending[0]
+            await self.global_bucket.acquire()
+            bucket.take()
+            item.attempts += 1
+            try:
+                result = await self.bot(item.method)
+            except TelegramRetryAfter as e:
+                item.attempts -= 1  # flood control is not the message's fault
+                self.retried += 1
+                log.warning("Flood control for chat %s: retry after %ss", chat_id, e.retry_after)
+                self._schedule(chat_id, e.retry_after)
+                return
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if item.attempts < self.max_attempts:
+                    self.retried += 1
+                    backoff = min(60, 2 ** item.attempts)
+                    log.warning("Send to %s failed (%s), retry %s in %ss", chat_id, e, item.attempts, backoff)
+                    self._schedule(chat_id, backoff)
+                    return
+                pending.popleft()
+                self._dead(item, e)
+                continue
+            except TelegramBadRequest as e:
+                pending.popleft()
+                if any(s in e.message for s in item.expected):
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                    continue
+                if "message is not modified" not in e.message:
+                    self._dead(item, e)
+                    continue
+                result = None  # an edit to the text it already has
+            except Exception as e:
+                pending.popleft()
+                self._dead(item, e)
+                continue
+            else:
+                pending.popleft()
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+
+        # nothing left for this chat
+        self._chats.pop(chat_id, None)
+        self._busy.discard(chat_id)
+        if bucket.full():
+            self._buckets.pop(chat_id, None)
+
+    def _dead(self, item: _Outgoing, error: Exception):
+        self.failed += 1
+        self.dead_letters.append((time.time(), item.chat_id, type(item.method).__name__, f"{type(error).__name__}: {error}"))
+        log.error("Dropped %s to chat %s after %s attempts: %s",
+                  type(item.method).__name__, item.chat_id, item.attempts, error)
+        if not item.future.done():
+            item.future.set_exception(error)
+            # mark retrieved so fire-and-forget callers don't get 'exception never retrieved' noise
+            item.future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "pending_chats": len(self._chats),
+            "pending": sum(len(q) for q in self._chats.values()),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dead_letters": len(self.dead_letters),
+        }
+
+
+outbox = Outbox(bot, workers=OUT_WORKERS, max_attempts=OUT_MAX_ATTEMPTS)
+
+
+# =========================
+# TICKET CARDS
+# one message per ticket in the operators group (tickets.card_message_id), edited
+# in place with the current status, operator and last message. touch() marks a
+# ticket dirty; the card is re-rendered CARD_EDIT_DELAY_MS later, so a burst of
+# changes costs one edit, and skipped when the text didn't change.
+# =========================
+CARD_EDIT_DELAY_MS = int(os.getenv("CARD_EDIT_DELAY_MS", "1500").strip() or "1500")
+CARD_LAST_CHARS = 300
+CARD_ICONS = {"new": "🆕", "in_progress": "🟡", "closed": "🔒"}
+
+_CARD_SQL = """
+    SELECT t.ticket_id, t.client_tg_id, t.service, t.status, t.assigned_operator_id, t.card_message_id,
+           c.name, c.surname, c.phone, c.lang, m.from_role, m.text, m.media_type
+    FROM tickets t
+    LEFT JOIN clients c ON c.tg_id = t.client_tg_id
+    LEFT JOIN messages m ON m.id = (
+        SELECT id FROM messages WHERE ticket_id = t.ticket_id ORDER BY created_at DESC, id DESC LIMIT 1
+    )
+    WHERE t.ticket_id = ?
+"""
+
+
+def render_card(row) -> tuple[str, InlineKeyboardMarkup | None]:
+    ticket_id, _, service, status, operator_id, _, name, surname, phone, lang, role, text, media_type = row
+    lang = lang or DEFAULT_LANG
+    last = ""
+    if role:
+        body = text or ""
+        if len(body) > CARD_LAST_CHARS:
+            body = body[:CARD_LAST_CHARS] + "…"
+        if media_type:
+            body = f"[{media_type}] {body}".strip()
+        last = f"{'🎧' if role == 'operator' else '👤'} “{html.escape(body)}”"
+    esc = lambda v: html.escape(v or "")
+    text = tr(lang, "ticket_card", icon=CARD_ICONS.get(status, "•"), ticket=ticket_id, service=esc(service),
+              name=esc(name), surname=esc(surname), phone=esc(phone), status=status,
+              operator=operator_id or "—", last=last)
+    return text, None if status == "closed" else kb_ticket_actions(lang, ticket_id)
+
+
+class TicketCards:
+    def __init__(self, chat_id: int, delay_ms: int = 1500):
+        self.chat_id = chat_id
+        self.delay = max(0, delay_ms) / 1000
+        self._dirty: set[str] = set()
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._now = asyncio.Event()  # set on close: flush without waiting
+        self._rendered = TTLCache(maxsize=5000, ttl=24 * 3600)  # ticket_id -> last text sent
+        self._media: dict[str, list[list[Message]]] = {}  # ticket_id -> client media waiting for the card
+        self.touches = 0
+        self.sent = 0
+        self.edited = 0
+        self.unchanged = 0
+
+    def touch(self, ticket_id: str, media: list[Message] | None = None):
+        """Schedule a refresh of the ticket's card; cheap, call it after any change. `media` is copied after the card."""
+        if not self.chat_id:
+            return
+        if media:
+            self._media.setdefault(ticket_id, []).append(media)
+        self.touches += 1
+        self._dirty.add(ticket_id)
+        if ticket_id not in self._tasks:
+            self._tasks[ticket_id] = asyncio.create_task(self._run(ticket_id), name=f"card-{ticket_id}")
+
+    async def _run(self, ticket_id: str):
+        try:
+            # touches that arrive while a card is being sent get one more round
+            while ticket_id in self._dirty:
+                if not self._now.is_set():
+                    try:
+                        await asyncio.wait_for(self._now.wait(), self.delay)
+                    except TimeoutError:
+                        pass
+                self._dirty.discard(ticket_id)
+                try:
+                    await self._flush(ticket_id)
+                except Exception:
+                    log.exception("Ticket card for %s failed", ticket_id)
+        finally:
+            del self._tasks[ticket_id]
+
+    async def _flush(self, ticket_id: str):
+        media = self._media.pop(ticket_id, [])
+        card_id = None
+        try:
+            card_id = await self._render(ticket_id)
+        finally:
+            # queued only now, so the outbox (FIFO per chat) delivers them after the card;
+            # single copies also reply to it (copyMessages can't)
+            for batch in media:
+                relay(batch, self.chat_id, reply_to=card_id)
+
+    async def _render(self, ticket_id: str) -> int | None:
+        """Send or edit the card; returns its message_id."""
+        row = await db_pool.fetchone(_CARD_SQL, (ticket_id,))
+        if row is None:
+            return None
+        text, markup = render_card(row)
+        message_id = row[5]
+        if message_id and self._rendered.get(ticket_id, None) == text:
+            self.unchanged += 1
+            return message_id
+        if message_id:
+            try:
+                await outbox.call(self.chat_id, EditMessageText(
+                    chat_id=self.chat_id, message_id=message_id, text=text, reply_markup=markup,
+                ), expected=("message to edit not found",))
+                self.edited += 1
+                self._rendered.set(ticket_id, text)
+                return message_id
+            except TelegramBadRequest as e:
+                # deleted by someone in the group: post a fresh card
+                log.warning("Card of %s can't be edited (%s), sending a new one", ticket_id, e.message)
+        msg = await outbox.call(self.chat_id, SendMessage(chat_id=self.chat_id, text=text, reply_markup=markup))
+        self.sent += 1
+        self._rendered.set(ticket_id, text)
+        await db_pool.execute("UPDATE tickets SET card_message_id=? WHERE ticket_id=?", (msg.message_id, ticket_id))
+        return msg.message_id
+
+    async def close(self):
+        """Render pending cards right away."""
+        self._now.set()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._tasks), "touches": self.touches, "sent": self.sent,
+                "edited": self.edited, "unchanged": self.unchanged}
+
+
+ticket_cards = TicketCards(OPERATORS_GROUP_ID, CARD_EDIT_DELAY_MS)
+
+
+# =========================
+# TICKET LIFECYCLE
+# background sweep: auto-close tickets with no activity for STALE_TICKET_HOURS,
+# remind the assigned operator when the client's last message waits REMIND_AFTER_MIN.
+# Candidates come from keyset batches on (status, updated_at, ticket_id); a ticket's
+# last message is one lookup on (ticket_id, created_at). 0 disables either job.
+# =========================
+LIFECYCLE_INTERVAL_SEC = float(os.getenv("LIFECYCLE_INTERVAL_SEC", "300").strip() or "300")
+LIFECYCLE_BATCH = int(os.getenv("LIFECYCLE_BATCH", "200").strip() or "200")
+STALE_TICKET_HOURS = float(os.getenv("STALE_TICKET_HOURS", "168").strip() or "168")
+REMIND_AFTER_MIN = float(os.getenv("REMIND_AFTER_MIN", "60").strip() or "60")
+
+
+class TicketLifecycle:
+    def __init__(self, pool: DBPool, interval_sec: float = 300, batch: int = 200,
+                 stale_hours: float = 168, remind_after_min: float = 60):
+        self.pool = pool
+        self.interval = max(1.0, interval_sec)
+        self.batch = max(1, batch)
+        self.stale_hours = stale_hours
+        self.remind_after_min = remind_after_min
+        self._task: asyncio.Task | None = None
+        self._stop = asyncio.Event()
+        self.closed = 0
+        self.reminded = 0
+
+    async def start(self):
+        if self._task is None and (self.stale_hours > 0 or self.remind_after_min > 0):
+            self._stop.clear()
+            self._task = asyncio.create_task(self._loop(), name="ticket-lifecycle")
+
+    async def close(self):
+        """Let the running sweep finish its current batch, then stop."""
+        if self._task is not None:
+            self._stop.set()
+            await self._task
+            self._task = None
+
+    async def _loop(self):
+        while not self._stop.is_set():
+            try:
+                closed, reminded = await self.run_once()
+                if closed or reminded:
+                    log.info("Lifecycle sweep: %s tickets auto-closed, %s reminders", closed, reminded)
+            except Exception:
+                log.exception("Lifecycle sweep failed")
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _batches(self, status: str, cutoff: str):
+        """Tickets in `status` not updated since `cutoff`, oldest first, with their last message."""
+        after = ("", "")
+        while not self._stop.is_set():
+            rows = await self.pool.fetchall("""
+                SELECT t.ticket_id, t.client_tg_id, t.assigned_operator_id, t.reminded_at,
+                       m.from_role, m.created_at, t.updated_at
+                FROM tickets t
+                LEFT JOIN messages m ON m.id = (
+                    SELECT id FROM messages WHERE ticket_id = t.ticket_id
+                    ORDER BY created_at DESC, id DESC LIMIT 1
+                )
+                WHERE t.status = ? AND t.updated_at < ? AND (t.updated_at, t.ticket_id) > (?, ?)
+                ORDER BY t.updated_at, t.ticket_id LIMIT ?
+            """, (status, cutoff, *after, self.batch))
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.batch:
+                return
+            after = (rows[-1][6], rows[-1][0])
+
+    async def run_once(self) -> tuple[int, int]:
+        now = datetime.now(UTC)
+        closed = reminded = 0
+        if self.stale_hours > 0:
+            cutoff = (now - timedelta(hours=self.stale_hours)).isoformat()
+            for status in ("new", "in_progress"):
+                async for rows in self._batches(status, cutoff):
+                    for ticket_id, client_id, operator_id, _, _, last_at, _ in rows:
+                        if last_at is None or last_at < cutoff:
+                            closed += await self._auto_close(ticket_id, status, client_id, operator_id, cutoff)
+        if self.remind_after_min > 0:
+            cutoff = (now - timedelta(minutes=self.remind_after_min)).isoformat()
+            async for rows in self._batches("in_progress", cutoff):
+                for ticket_id, _, operator_id, reminded_at, last_role, last_at, _ in rows:
+                    if (operator_id and last_role == "client" and last_at < cutoff
+                            and (reminded_at is None or reminded_at < last_at)):
+                        await self._remind(ticket_id, operator_id, last_at, now)
+                        reminded += 1
+        self.closed += closed
+        self.reminded += reminded
+        return closed, reminded
+
+    async def _auto_close(self, ticket_id: str, status: str, client_id: int,
+                          operator_id: int | None, cutoff: str) -> int:
+        # guarded: an operator action or a new message since the scan keeps the ticket open
+        res = await transition(ticket_id, "close", None, guard="""
+            status=:status AND updated_at < :cutoff
+            AND NOT EXISTS (SELECT 1 FROM messages WHERE ticket_id=:ticket AND created_at >= :cutoff)
+        """, status=status, cutoff=cutoff)
+        if not res.ok:
+            return 0
+        if operator_id and ACTIVE_TICKET.get(operator_id) == ticket_id:
+            ACTIVE_TICKET.pop(operator_id, None)
+        outbox.send(client_id, tr(await get_lang(client_id), "ticket_closed"))
+        return 1
+
+    async def _remind(self, ticket_id: str, operator_id: int, last_at: str, now: datetime):
+        await self.pool.execute("UPDATE tickets SET reminded_at=? WHERE ticket_id=?", (now.isoformat(), ticket_id))
+        lang = await get_lang(operator_id)
+        waiting = int((now - datetime.fromisoformat(last_at)).total_seconds() // 60)
+        outbox.send(
+            operator_id,
+            tr(lang, "ticket_reminder", ticket=ticket_id, minutes=waiting),
+            reply_markup=kb_ticket_actions(lang, ticket_id),
+        )
+
+
+lifecycle = TicketLifecycle(db_pool, interval_sec=LIFECYCLE_INTERVAL_SEC, batch=LIFECYCLE_BATCH,
+                            stale_hours=STALE_TICKET_HOURS, remind_after_min=REMIND_AFTER_MIN)
+
+
+# =========================
+# MEDIA RELAY
+# non-text messages are relayed with copyMessage(s): Telegram reuses the stored
+# file, the bot never downloads or re-uploads it. Album parts arrive as separate
+# updates; the first handler waits ALBUM_WAIT_MS after the last part and relays
+# the whole group in one copyMessages call, the other handlers return early.
+# =========================
+ALBUM_WAIT_MS = int(os.getenv("ALBUM_WAIT_MS", "700").strip() or "700")
+
+_albums: dict[tuple[int, str], list[Message]] = {}
+
+
+async def collect_album(message: Message) -> list[Message] | None:
+    """[message] for a single message, the full album for its first part, None for the other parts."""
+    if not message.media_group_id:
+        return [message]
+    key = (message.chat.id, message.media_group_id)
+    parts = _albums.get(key)
+    if parts is not None:
+        parts.append(message)
+        return None
+    parts = _albums[key] = [message]
+    seen = 0
+    while seen != len(parts):
+        seen = len(parts)
+        await asyncio.sleep(ALBUM_WAIT_MS / 1000)
+    del _albums[key]
+    return sorted(parts, key=lambda m: m.message_id)
+
+async def log_batch(ticket_id: str, from_role: str, batch: list[Message], received: list[str] | None = None):
+    """Log several messages with one multi-row INSERT; `received` overrides created_at per message."""
+    now = datetime.now(UTC).isoformat()
+    params = []
+    for i, m in enumerate(batch):
+        media_type, file_id = message_media(m)
+        params += (ticket_id, from_role, (m.text or m.caption or "").strip(),
+                   received[i] if received else now, media_type, file_id)
+    await db_pool.execute(f"""
+        INSERT INTO messages (ticket_id, from_role, text, created_at, media_type, file_id)
+        VALUES {", ".join(["(?, ?, ?, ?, ?, ?)"] * len(batch))}
+    """, tuple(params), wait=False)
+
+def media_label(batch: list[Message]) -> str:
+    """Short description for notifications: 📎 photo / 📎 3× photo, document."""
+    kinds: dict[str, int] = {}
+    for m in batch:
+        kind = message_media(m)[0]
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return "📎 " + ", ".join(f"{n}× {k}" if n > 1 else k for k, n in kinds.items())
+
+def relay(batch: list[Message], chat_id: int, reply_to: int | None = None) -> asyncio.Future:
+    """Copy a message or a whole album to chat_id through the outbox (`reply_to` applies to single messages)."""
+    if len(batch) == 1:
+        method = CopyMessage(
+            chat_id=chat_id, from_chat_id=batch[0].chat.id, message_id=batch[0].message_id,
+            reply_parameters=ReplyParameters(message_id=reply_to, allow_sending_without_reply=True) if reply_to else None,
+        )
+    else:
+        method = CopyMessages(chat_id=chat_id, from_chat_id=batch[0].chat.id,
+                              message_ids=[m.message_id for m in batch])
+    return outbox.call(chat_id, method)
+
+
+# =========================
+# CLIENT DIGEST
+# a client typing 5-10 short lines gives the operator one notification, not ten:
+# messages of an open ticket are gathered until CLIENT_DIGEST_MS pass without a new
+# one (at most CLIENT_DIGEST_MAX_MS after the first), then logged with one INSERT
+# and sent as a single ticket_text_msg; media go out in one copyMessages call.
+# =========================
+CLIENT_DIGEST_MS = int(os.getenv("CLIENT_DIGEST_MS", "1200").strip() or "1200")
+CLIENT_DIGEST_MAX_MS = int(os.getenv("CLIENT_DIGEST_MAX_MS", "5000").strip() or "5000")
+CLIENT_DIGEST_MAX = 50  # messages per digest; copyMessages takes at most 100 ids
+
+
+class _Digest:
+    __slots__ = ("ticket_id", "client_id", "messages", "received", "started", "deadline", "task")
+
+    def __init__(self, ticket_id: str, client_id: int):
+        self.ticket_id = ticket_id
+        self.client_id = client_id
+        self.messages: list[Message] = []
+        self.received: list[str] = []
+        self.started = time.monotonic()
+        self.deadline = self.started
+        self.task: asyncio.Task | None = None
+
+
+class TicketDigest:
+    def __init__(self, window_ms: int = 1200, max_wait_ms: int = 5000, max_messages: int = 50):
+        self.window = max(0, window_ms) / 1000
+        self.max_wait = max(self.window, max_wait_ms / 1000)
+        self.max_messages = max(1, max_messages)
+        self._pending: dict[str, _Digest] = {}
+        self.messages = 0
+        self.flushes = 0
+
+    def pending(self, ticket_id: str) -> bool:
+        return ticket_id in self._pending
+
+    def add(self, ticket_id: str, client_id: int, message: Message, window: float | None = None):
+        """Queue a client message; `window` (seconds) stretches the quiet period, e.g. for flooders."""
+        window = self.window if window is None else window
+        d = self._pending.get(ticket_id)
+        if d is None:
+            d = self._pending[ticket_id] = _Digest(ticket_id, client_id)
+            d.task = asyncio.create_task(self._flush_later(d), name=f"digest-{ticket_id}")
+        d.messages.append(message)
+        d.received.append(datetime.now(UTC).isoformat())
+        self.messages += 1
+        now = time.monotonic()
+        d.deadline = min(now + window, d.started + max(self.max_wait, window))
+        if len(d.messages) >= self.max_messages:
+            d.deadline = now
+
+    async def _flush_later(self, d: _Digest):
+        while (wait := d.deadline - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+        if self._pending.get(d.ticket_id) is d:
+            del self._pending[d.ticket_id]
+        try:
+            await self._flush(d)
+        except Exception:
+            log.exception("Client digest for %s failed", d.ticket_id)
+
+    async def _flush(self, d: _Digest):
+        self.flushes += 1
+        await log_batch(d.ticket_id, "client", d.messages, d.received)
+        media = [m for m in d.messages if m.text is None]
+
+        # беремо актуального оператора (якщо вже призначений)
+        t = open_tickets.get(d.client_id)
+        if not t or t.ticket_id != d.ticket_id or not t.assigned_operator_id:
+            # nobody has it yet: the files follow the card in the group, like the first message's
+            ticket_cards.touch(d.ticket_id, media=media)
+            return
+        ticket_cards.touch(d.ticket_id)
+        lang = await get_lang(d.client_id)
+        client = await get_client(d.client_id)
+        phone = client[1] if client else ""
+        surname = client[2] if client else ""
+        name = client[3] if client else ""
+        lines = [m.text.strip() for m in d.messages if m.text]
+        if media:
+            lines.append(media_label(media))
+        msg_to_ops = tr(lang, "ticket_text_msg", ticket=d.ticket_id, name=name, surname=surname,
+                        phone=phone, msg="\n".join(lines))
+
+        # ✅ якщо є assigned оператор — в приват оператору + автоактивація чату
+        outbox.send(t.assigned_operator_id, msg_to_ops)
+        if media:
+            relay(media, t.assigned_operator_id)
+        ACTIVE_TICKET[t.assigned_operator_id] = d.ticket_id
+
+    async def close(self):
+        """Flush whatever is still pending right away."""
+        pending = list(self._pending.values())
+        for d in pending:
+            d.deadline = 0
+        await asyncio.gather(*(d.task for d in pending), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "messages": self.messages, "flushes": self.flushes}
+
+
+client_digest = TicketDigest(CLIENT_DIGEST_MS, CLIENT_DIGEST_MAX_MS, CLIENT_DIGEST_MAX)
+
+
+# =========================
+# ANTI-FLOOD
+# outer middleware on private messages/callbacks from non-admins. Each handler group
+# (message / command / callback) has its own sliding window per user, set with
+# FLOOD_LIMITS="message=8/10,command=5/10,callback=10/5" (hits/seconds).
+# A client over the limit in an open ticket is not dropped: the message joins the
+# ticket's client digest with a FLOOD_DIGEST_SEC quiet period, so a burst costs one
+# insert and one notification. Everything else over the limit gets one "slow down" per window.
+# =========================
+FLOOD_LIMITS = os.getenv("FLOOD_LIMITS", "message=8/10,command=5/10,callback=10/5").strip()
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "10000").strip() or "10000")
+FLOOD_DIGEST_SEC = float(os.getenv("FLOOD_DIGEST_SEC", "5").strip() or "5")
+
+
+def parse_flood_limits(raw: str) -> dict[str, tuple[int, float]]:
+    limits = {}
+    for part in raw.split(","):
+        group, _, rate = part.strip().partition("=")
+        hits, _, window = rate.partition("/")
+        try:
+            limits[group.strip()] = (int(hits), float(window))
+        except ValueError:
+            log.warning("FLOOD_LIMITS: ignoring %r", part)
+    return limits
+
+
+class SlidingWindow:
+    """Per-key sliding-window log. LRU-ordered; keys idle for a whole window (or over maxsize) are evicted."""
+
+    def __init__(self, limit: int, window: float, maxsize: int = 10000):
+        self.limit = max(1, limit)
+        self.window = window
+        self.maxsize = max(1, maxsize)
+        self._keys: OrderedDict = OrderedDict()  # key -> deque of allowed hit times
+
+    def hit(self, key) -> bool:
+        now = time.monotonic()
+        hits = self._keys.get(key)
+        if hits is None:
+            hits = self._keys[key] = deque()
+        else:
+            self._keys.move_to_end(key)
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        allowed = len(hits) < self.limit
+        if allowed:
+            hits.append(now)
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now: float):
+        while self._keys:
+            hits = next(iter(self._keys.values()))
+            if len(self._keys) <= self.maxsize and hits and hits[-1] > now - self.window:
+                break
+            self._keys.popitem(last=False)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    def __init__(self, limits: dict[str, tuple[int, float]], max_users: int = 10000, digest_sec: float = 5):
+        self.limiters = {g: SlidingWindow(n, w, max_users) for g, (n, w) in limits.items()}
+        self.digest_sec = digest_sec
+        self._warned = TTLCache(max_users, ttl=max((w for _, w in limits.values()), default=10))
+        self._albums = TTLCache(1000, ttl=60)  # media_group_ids already counted
+        self.throttled = 0
+
+    @staticmethod
+    def _group(event) -> str:
+        if isinstance(event, CallbackQuery):
+            return "callback"
+        return "command" if is_command_text(event.text) else "message"
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is None or is_admin(user.id) or chat is None or chat.type != ChatType.PRIVATE:
+            return await handler(event, data)
+        group = self._group(event)
+        limiter = self.limiters.get(group)
+        # album parts after the first one ride on its hit
+        album = event.media_group_id if isinstance(event, Message) else None
+        first_part = not album or self._albums.get(album, None) is None
+        if album:
+            self._albums.set(album, True)
+        if limiter is None or not first_part or limiter.hit(user.id):
+            return await handler(event, data)
+
+        self.throttled += 1
+        t = open_tickets.get(user.id)
+        if group == "message" and data.get("raw_state") is None and t:
+            client_digest.add(t.ticket_id, user.id, event, window=self.digest_sec)
+            return None
+        if self._warned.get(user.id, None) is None:
+            self._warned.set(user.id, True)
+            text = tr(await get_lang(user.id), "flood_slow_down")
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+            else:
+                outbox.send(chat.id, text)
+        elif isinstance(event, CallbackQuery):
+            await event.answer()
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "users": sum(len(l) for l in self.limiters.values()),
+            "throttled": self.throttled,
+        }
+
+
+antiflood = AntiFloodMiddleware(parse_flood_limits(FLOOD_LIMITS), max_users=FLOOD_MAX_USERS,
+                                digest_sec=FLOOD_DIGEST_SEC)
+dp.message.outer_middleware(antiflood)
+dp.callback_query.outer_middleware(antiflood)
+
+
+# =========================
+# PER-CHAT SERIALIZATION
+# updates run as concurrent tasks (polling and webhook); two quick messages of the
+# same client must not both pass "no open ticket" before either creates one.
+# Updates of one (chat, user) run one at a time, different users stay parallel.
+# Keyed like the FSM, so operators sharing the group chat don't queue behind each other.
+# =========================
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "0").strip() or "0")  # max handlers running at once; 0 = no cap
+
+
+class KeyedLock:
+    """One asyncio.Lock per key, dropped as soon as nobody holds or waits for it: the table only holds in-flight keys."""
+
+    def __init__(self):
+        self._locks: dict[object, list] = {}  # key -> [lock, holders + waiters]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class ChatSerializer(BaseMiddleware):
+    def __init__(self, concurrency: int = 0):
+        self.locks = KeyedLock()
+        # taken only after the chat lock, so queued updates of a busy chat don't hold slots
+        self._slots = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.waited = 0
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is None and chat is None:
+            return await handler(event, data)
+        # later parts of an album are collected by the handler already running for the first one
+        if isinstance(event, Message) and event.media_group_id and (event.chat.id, event.media_group_id) in _albums:
+            return await handler(event, data)
+        key = (chat.id if chat else None, user.id if user else None)
+        t0 = time.perf_counter()
+        async with self.locks.hold(key):
+            waited = time.perf_counter() - t0
+            if waited > 0.001:
+                self.waited += 1
+            metrics.observe("bot_chat_lock_wait_seconds", waited)
+            # the FSM middleware read the state before we got here: an update of the same
+            # chat may have changed it since, and state filters must see what it left behind
+            state = data.get("state")
+            if state is not None:
+                data["raw_state"] = await state.get_state()
+            if self._slots is None:
+                return await handler(event, data)
+            async with self._slots:
+                return await handler(event, data)
+
+    def stats(self) -> dict:
+        return {"keys": len(self.locks), "waited": self.waited}
+
+
+serializer = ChatSerializer(UPDATE_CONCURRENCY)
+# after anti-flood: throttled updates are dropped without queueing
+dp.message.outer_middleware(serializer)
+dp.callback_query.outer_middleware(serializer)
+
+# hooks run in registration order: stop the producers first so their last
+# notifications are still flushed by the outbox before the dispatcher closes the bot session
+dp.shutdown.register(lifecycle.close)
+dp.shutdown.register(client_digest.close)
+dp.shutdown.register(ticket_cards.close)
+dp.shutdown.register(outbox.close)
+
+
+# ---------- metrics hooks ----------
+class HandlerMetrics(BaseMiddleware):
+    """Inner middleware: runs only once a handler matched, so the label is the handler function."""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - t0, handler=name)
+
+
+async def api_metrics(make_request, bot: Bot, method: TelegramMethod):
+    name = method.__api_method__
+    t0 = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        metrics.inc("bot_api_errors_total", method=name, error=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("bot_api_seconds", time.perf_counter() - t0, method=name)
+
+
+handler_metrics = HandlerMetrics()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+bot.session.middleware(api_metrics)
+
+metrics.gauge("bot_outbox_pending", "Messages queued in the outbox.", lambda: outbox.stats()["pending"])
+metrics.gauge("bot_outbox_dead_letters", "Messages the outbox gave up on.", lambda: len(outbox.dead_letters))
+metrics.gauge("bot_db_write_queue", "Writes waiting for the batching writer.", lambda: db_pool._queue.qsize())
+metrics.gauge("bot_open_tickets", "Open tickets in the in-memory index.", lambda: len(open_tickets.by_client))
+metrics.gauge("bot_client_digest_pending", "Client messages waiting to be coalesced.", lambda: client_digest.stats()["pending"])
+metrics.gauge("bot_antiflood_users", "Users tracked by the anti-flood limiter.", lambda: antiflood.stats()["users"])
+metrics.gauge("bot_ticket_cards_pending", "Ticket cards waiting to be re-rendered.", lambda: ticket_cards.stats()["pending"])
+metrics.gauge("bot_chat_locks", "Chats with an update running or queued.", lambda: len(serializer.locks))
 
 
 # =========================
@@ -493,6 +2902,87 @@ async def whoami(message: Message):
     lang = await get_lang(message.from_user.id)
     await message.answer(f"ID: {message.from_user.id}\nADMIN: {is_admin(message.from_user.id)}\nLANG: {lang}")
 
+@dp.message(Command("indexcheck"))
+async def index_check(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    repair = "fix" in (message.text or "").split()[1:]
+    diffs = await open_tickets.check(repair=repair)
+    if not diffs:
+        await message.answer(f"✅ Open ticket index OK ({len(open_tickets.by_client)} tickets).")
+        return
+    shown = "\n".join(diffs[:20])
+    more = f"\n… +{len(diffs) - 20}" if len(diffs) > 20 else ""
+    tail = "\n🔧 Index rebuilt from DB." if repair else "\n/indexcheck fix — rebuild from DB"
+    await message.answer(f"⚠️ {len(diffs)} mismatches:\n<code>{html.escape(shown)}</code>{more}{tail}")
+
+@dp.message(Command("deadletters"))
+async def dead_letters(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    if not outbox.dead_letters:
+        await message.answer("✅ Dead letters: none.")
+        return
+    lines = [
+        f"{datetime.fromtimestamp(ts, UTC):%d.%m %H:%M:%S} → {chat_id} {method}: {err}"
+        for ts, chat_id, method, err in list(outbox.dead_letters)[-15:]
+    ]
+    await message.answer(f"📭 Dead letters ({len(outbox.dead_letters)}):\n<code>{html.escape(chr(10).join(lines))}</code>")
+
+@dp.message(Command("stats"))
+async def stats(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    cs = client_cache.stats()
+    os_ = outbox.stats()
+    fs = antiflood.stats()
+    ds = client_digest.stats()
+    ss = serializer.stats()
+    tc = ticket_cards.stats()
+    await message.answer(
+        f"client cache: {cs['size']} entries\n"
+        f"hits: {cs['hits']} | misses: {cs['misses']} | hit rate: {cs['hit_rate']}\n"
+        f"evictions: {cs['evictions']}\n\n"
+        f"outbox: sent {os_['sent']} | pending {os_['pending']} | retried {os_['retried']} | failed {os_['failed']}\n"
+        f"client digest: {ds['messages']} messages in {ds['flushes']} notifications | pending {ds['pending']}\n"
+        f"ticket cards: {tc['touches']} updates -> sent {tc['sent']} | edited {tc['edited']} | unchanged {tc['unchanged']}\n"
+        f"anti-flood: throttled {fs['throttled']} | users {fs['users']}\n"
+        f"chat locks: {ss['keys']} active | {ss['waited']} updates queued behind their chat"
+    )
+
+def _metrics_table(name: str, label: str, top: int = 10, errors: str | None = None) -> str:
+    """Slowest `top` series of a histogram by total time: count, p50, p95, total (and errors)."""
+    failed: dict[str, float] = {}
+    for labels, n in metrics.counters(errors).items() if errors else ():
+        key = dict(labels)[label]
+        failed[key] = failed.get(key, 0) + n
+    rows = sorted(metrics.series(name).items(), key=lambda kv: kv[1].sum, reverse=True)[:top]
+    lines = []
+    for labels, h in rows:
+        main = dict(labels)[label]
+        rest = ",".join(str(v) for k, v in labels if k != label)
+        key = f"{main} ({rest})" if rest else main
+        err = failed.get(main, 0)
+        lines.append(
+            f"{key[:32]:<32} {h.count:>6} {h.quantile(.5) * 1000:>6g} {h.quantile(.95) * 1000:>6g} "
+            f"{h.sum:>7.1f}s" + (f" ✗{err:g}" if err else "")
+        )
+    return "\n".join(lines) or "—"
+
+@dp.message(Command("metrics"))
+async def metrics_summary(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    head = f"{'':<32} {'count':>6} {'p50ms':>6} {'p95ms':>6} {'total':>8}"
+    sections = (
+        ("handlers", _metrics_table("bot_handler_seconds", "handler", errors="bot_handler_errors_total")),
+        ("db", _metrics_table("bot_db_query_seconds", "query", errors="bot_db_errors_total")),
+        ("bot api", _metrics_table("bot_api_seconds", "method", errors="bot_api_errors_total")),
+    )
+    body = "\n\n".join(f"<b>{title}</b>\n<code>{html.escape(head)}\n{html.escape(table)}</code>"
+                        for title, table in sections)
+    await message.answer(f"📈 Metrics (full export: {METRICS_PATH})\n\n{body}")
+
 @dp.message(Command("admin"))
 async def admin_panel(message: Message):
     lang = await get_lang(message.from_user.id)
@@ -500,13 +2990,98 @@ async def admin_panel(message: Message):
         await message.answer(tr(lang, "admin_denied"))
         return
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=tr(lang, "admin_new"), callback_data="adm:list:new")],
-        [InlineKeyboardButton(text=tr(lang, "admin_progress"), callback_data="adm:list:in_progress")],
-        [InlineKeyboardButton(text=tr(lang, "admin_closed"), callback_data="adm:list:closed")],
-        [InlineKeyboardButton(text=tr(lang, "admin_search"), callback_data="adm:search:ask")],
-    ])
-    await message.answer(tr(lang, "admin_title"), reply_markup=kb)
+    await message.answer(tr(lang, "admin_title"), reply_markup=kb_admin(lang))
+
+# ---------- ADMIN: paginated ticket browser ----------
+# View state (filter + keyset cursors) lives server-side, keyed by a short id, so
+# callback_data stays within Telegram's 64 bytes: "adm:pg:<view>:n|p".
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "15").strip() or "15")
+TICKET_STATUSES = ("new", "in_progress", "closed")
+
+
+class TicketBrowser:
+    __slots__ = ("owner_id", "filter", "page_size", "cursors", "next_cursor")
+
+    def __init__(self, owner_id: int, f: TicketFilter, page_size: int):
+        self.owner_id = owner_id  # only the admin who opened the view may page it
+        self.filter = f
+        self.page_size = page_size
+        self.cursors: list[tuple[str, str] | None] = [None]  # `after` cursor of each visited page
+        self.next_cursor: tuple[str, str] | None = None
+
+
+# view ids are random so a button from before a restart can't land on a newer view
+_browsers = TTLCache(maxsize=1000, ttl=6 * 3600)
+
+
+def new_browser_id() -> str:
+    return secrets.token_hex(6)
+
+
+def _browser_filters_text(f: TicketFilter) -> str:
+    parts = []
+    if f.service:
+        parts.append(f"service={f.service}")
+    if f.operator_id is not None:
+        parts.append(f"op={f.operator_id or 'none'}")
+    if f.date_from:
+        parts.append(f"from={f.date_from}")
+    if f.date_to:
+        parts.append(f"to={f.date_to}")
+    return f" [{html.escape(' '.join(parts))}]" if parts else ""
+
+
+async def render_browser(view_id: str, view: TicketBrowser, lang: str):
+    rows = await list_tickets_page(view.filter, view.page_size + 1, after=view.cursors[-1])
+    has_next = len(rows) > view.page_size
+    rows = rows[:view.page_size]
+    view.next_cursor = (rows[-1][3], rows[-1][0]) if has_next else None
+
+    if not rows:
+        return tr(lang, "tickets_none"), None
+
+    lines = [f"• <b>{r[0]}</b> — {html.escape(r[1] or '')} — <i>{r[2]}</i>" for r in rows]
+    text = tr(lang, "tickets_page", status=view.filter.status, filters=_browser_filters_text(view.filter),
+              page=len(view.cursors), lines="\n".join(lines))
+    nav = []
+    if len(view.cursors) > 1:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm:pg:{view_id}:p"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"adm:pg:{view_id}:n"))
+    return text, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
+
+async def open_browser(message: Message, owner_id: int, lang: str, f: TicketFilter,
+                       page_size: int = ADMIN_PAGE_SIZE):
+    view_id = new_browser_id()
+    view = TicketBrowser(owner_id, f, page_size)
+    _browsers.set(view_id, view)
+    text, kb = await render_browser(view_id, view, lang)
+    await message.answer(text, reply_markup=kb)
+
+
+def parse_ticket_filter(args: list[str]) -> tuple[TicketFilter, int] | None:
+    if not args or args[0] not in TICKET_STATUSES:
+        return None
+    opts = {}
+    for arg in args[1:]:
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            return None
+        opts[key] = value
+    try:
+        op = opts.get("op")
+        operator_id = None if op is None else (0 if op == "none" else int(op))
+        for k in ("from", "to"):
+            if k in opts:
+                datetime.strptime(opts[k], "%Y-%m-%d")
+        size = max(1, min(50, int(opts.get("size", ADMIN_PAGE_SIZE))))
+    except ValueError:
+        return None
+    if set(opts) - {"service", "op", "from", "to", "size"}:
+        return None
+    return TicketFilter(args[0], opts.get("service"), operator_id, opts.get("from"), opts.get("to")), size
+
 
 @dp.callback_query(F.data.startswith("adm:list:"))
 async def admin_list(cb: CallbackQuery):
@@ -516,21 +3091,65 @@ async def admin_list(cb: CallbackQuery):
         return
 
     status = cb.data.split(":")[2]
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT ticket_id, service, status
-            FROM tickets WHERE status=?
-            ORDER BY updated_at DESC LIMIT 15
-        """, (status,))
-        rows = await cur.fetchall()
-
-    if not rows:
-        await cb.message.answer(tr(lang, "tickets_none"))
+    if status not in TICKET_STATUSES:
         await cb.answer()
         return
+    await open_browser(cb.message, cb.from_user.id, lang, TicketFilter(status))
+    await cb.answer()
 
-    lines = [f"• <b>{r[0]}</b> — {r[1]} — <i>{r[2]}</i>" for r in rows]
-    await cb.message.answer(tr(lang, "tickets_list", lines="\n".join(lines)))
+@dp.message(Command("tickets"))
+async def admin_tickets(message: Message):
+    lang = await get_lang(message.from_user.id)
+    if not is_admin(message.from_user.id):
+        await message.answer(tr(lang, "admin_denied"))
+        return
+    parsed = parse_ticket_filter((message.text or "").split()[1:])
+    if parsed is None:
+        await message.answer(html.escape(tr(lang, "tickets_usage")))
+        return
+    f, size = parsed
+    await open_browser(message, message.from_user.id, lang, f, size)
+
+@dp.callback_query(F.data.startswith("adm:pg:"))
+async def admin_page(cb: CallbackQuery):
+    lang = await get_lang(cb.from_user.id)
+    if not is_admin(cb.from_user.id):
+        await cb.answer(tr(lang, "admin_denied"), show_alert=True)
+        return
+
+    _, _, view_id, direction = cb.data.split(":")
+    view = _browsers.get(view_id, None)
+    if view is None:
+        await cb.answer(tr(lang, "page_expired"), show_alert=True)
+        return
+    if view.owner_id != cb.from_user.id:
+        await cb.answer(tr(lang, "page_not_yours"), show_alert=True)
+        return
+
+    if direction == "n" and view.next_cursor:
+        view.cursors.append(view.next_cursor)
+    elif direction == "p" and len(view.cursors) > 1:
+        view.cursors.pop()
+    text, kb = await render_browser(view_id, view, lang)
+    try:
+        await cb.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await cb.answer()
+
+@dp.callback_query(F.data == "adm:catalog:reload")
+async def admin_catalog_reload(cb: CallbackQuery):
+    lang = await get_lang(cb.from_user.id)
+    if not is_admin(cb.from_user.id):
+        await cb.answer(tr(lang, "admin_denied"), show_alert=True)
+        return
+    error = services.reload()
+    cat = services.current
+    if error:
+        await cb.message.answer(tr(lang, "catalog_reload_failed", version=cat.version, error=html.escape(error[:3000])))
+    else:
+        await cb.message.answer(tr(lang, "catalog_reloaded", count=len(cat.service_keys), version=cat.version))
     await cb.answer()
 
 @dp.callback_query(F.data == "adm:search:ask")
@@ -553,8 +3172,9 @@ async def admin_search_do(message: Message, state: FSMContext):
     ticket_id = (message.text or "").strip()
     t = await get_ticket(ticket_id)
     if not t:
-        await message.answer(tr(lang, "ticket_not_found"))
+        # not an id: fall back to full-text search
         await state.clear()
+        await answer_search(message, lang, ticket_id, not_found_key="ticket_not_found")
         return
 
     assigned = str(t[4]) if t[4] else "—"
@@ -565,6 +3185,142 @@ async def admin_search_do(message: Message, state: FSMContext):
     await state.clear()
 
 
+async def answer_search(message: Message, lang: str, query: str, not_found_key: str = "find_none"):
+    rows = await search_tickets(query) if query else []
+    if not rows:
+        await message.answer(tr(lang, not_found_key))
+        return
+    lines = []
+    for ticket_id, status, service, name, surname, snip in rows:
+        who = html.escape(f"{name or ''} {surname or ''}".strip() or "—")
+        line = f"• <b>{ticket_id}</b> — {html.escape(service or '')} — <i>{status}</i> — {who}"
+        if snip:
+            snip = html.escape(snip).replace("\x02", "<b>").replace("\x03", "</b>")
+            line += f"\n   «{snip}»"
+        lines.append(line)
+    await message.answer(tr(lang, "find_results", query=html.escape(query), lines="\n".join(lines)))
+
+@dp.message(Command("find"))
+async def admin_find(message: Message, command: CommandObject):
+    lang = await get_lang(message.from_user.id)
+    if not is_admin(message.from_user.id):
+        await message.answer(tr(lang, "admin_denied"))
+        return
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer(tr(lang, "find_usage"))
+        return
+    await answer_search(message, lang, query)
+
+# ---------- ADMIN: conversation history ----------
+# Rows come from a cursor (DBPool.stream), never fetchall: the chat view stops after
+# HISTORY_MAX_CHUNKS messages. The export is encoded into a spooled temp file first
+# (memory up to HISTORY_SPOOL_BYTES, then disk), so a slow upload doesn't keep one
+# of the few pool readers away from get_client / FSM reads.
+HISTORY_MAX_CHUNKS = int(os.getenv("HISTORY_MAX_CHUNKS", "10").strip() or "10")
+HISTORY_SPOOL_BYTES = 1 << 20
+HISTORY_FORMATS = ("csv", "jsonl")
+HISTORY_COLUMNS = ("id", "from_role", "text", "created_at", "media_type", "file_id")
+
+
+class HistoryExport(InputFile):
+    """Upload body generated on the fly from the messages cursor (re-read from the DB on retry)."""
+
+    def __init__(self, ticket_id: str, fmt: str):
+        super().__init__(filename=f"{ticket_id}.{fmt}")
+        self.ticket_id = ticket_id
+        self.fmt = fmt
+
+    async def _dump(self, out):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if self.fmt == "csv":
+            buf.write("\ufeff")  # BOM: Excel opens cyrillic correctly
+            writer.writerow(HISTORY_COLUMNS)
+        async with aclosing(iter_history(self.ticket_id)) as rows:
+            async for row in rows:
+                if self.fmt == "csv":
+                    writer.writerow(row)
+                else:
+                    buf.write(json.dumps(dict(zip(HISTORY_COLUMNS, row)), ensure_ascii=False) + "\n")
+                if buf.tell() >= self.chunk_size:
+                    out.write(buf.getvalue().encode())
+                    buf.seek(0)
+                    buf.truncate()
+        out.write(buf.getvalue().encode())
+
+    async def read(self, bot: Bot):
+        with tempfile.SpooledTemporaryFile(max_size=HISTORY_SPOOL_BYTES) as spool:
+            await self._dump(spool)  # the reader goes back to the pool here, before any upload
+            spool.seek(0)
+            while chunk := spool.read(self.chunk_size):
+                yield chunk
+
+@dp.message(Command("history"))
+async def admin_history(message: Message, command: CommandObject):
+    lang = await get_lang(message.from_user.id)
+    if not is_admin(message.from_user.id):
+        await message.answer(tr(lang, "admin_denied"))
+        return
+    args = (command.args or "").split()
+    fmt = args[1].lower() if len(args) > 1 else None
+    if not args or len(args) > 2 or (fmt and fmt not in HISTORY_FORMATS):
+        await message.answer(tr(lang, "history_usage"))
+        return
+    t = await get_ticket(args[0])
+    if not t:
+        await message.answer(tr(lang, "ticket_not_found"))
+        return
+    ticket_id = t[0]
+    chat_id = message.chat.id
+
+    if fmt:
+        outbox.call(chat_id, SendDocument(
+            chat_id=chat_id, document=HistoryExport(ticket_id, fmt),
+            caption=tr(lang, "history_export", id=ticket_id, service=t[2], status=t[3]),
+        ))
+        return
+
+    await message.answer(tr(lang, "history_header", id=ticket_id, service=t[2], status=t[3]))
+    sent = 0
+    async with aclosing(iter_history(ticket_id)) as rows:
+        async for chunk in history_chunks(rows):
+            if sent == HISTORY_MAX_CHUNKS:
+                outbox.send(chat_id, tr(lang, "history_truncated", id=ticket_id))
+                break
+            outbox.send(chat_id, chunk)
+            sent += 1
+    if not sent:
+        outbox.send(chat_id, tr(lang, "history_empty"))
+
+@dp.message(Command("reopen"))
+async def admin_reopen(message: Message, command: CommandObject):
+    lang = await get_lang(message.from_user.id)
+    if not is_admin(message.from_user.id):
+        await message.answer(tr(lang, "admin_denied"))
+        return
+    args = (command.args or "").split()
+    if len(args) != 1:
+        await message.answer(tr(lang, "reopen_usage"))
+        return
+    res = await transition(args[0], "reopen", message.from_user.id)
+    if res.reason == "not_found":
+        await message.answer(tr(lang, "ticket_not_found"))
+        return
+    if res.reason == "assigned_other":
+        await message.answer(tr(lang, "assigned_other"))
+        return
+    ticket_id, status = res.ticket[0], res.ticket[3]
+    if res.reason == "client_has_open":
+        other = open_tickets.get(res.ticket[1])
+        await message.answer(tr(lang, "reopen_client_busy", ticket=ticket_id, other=other.ticket_id if other else "?"))
+        return
+    if not res.ok:
+        await message.answer(tr(lang, "ticket_wrong_state", ticket=ticket_id, status=status))
+        return
+    await message.answer(tr(lang, "reopened_ok", ticket=ticket_id, status=status))
+
+
 # =========================
 # START / REGISTRATION
 # =========================
@@ -637,14 +3393,8 @@ async def service_selected(cb: CallbackQuery):
 async def info_selected(cb: CallbackQuery):
     lang = await get_lang(cb.from_user.id)
     _, service_key, kind = cb.data.split(":")
-    if kind == "docs":
-        txt = DOCS.get(lang, {}).get(service_key, "—")
-        await cb.answer()
-        await cb.message.answer(tr(lang, "docs_title", service=service_key, txt=txt))
-    else:
-        txt = PRICE.get(lang, {}).get(service_key, "—")
-        await cb.answer()
-        await cb.message.answer(tr(lang, "price_title", service=service_key, txt=txt))
+    await cb.answer()
+    await cb.message.answer(info_text(lang, service_key, "docs" if kind == "docs" else "price"))
 
 @dp.callback_query(F.data == "op:choose")
 async def operator_choose(cb: CallbackQuery):
@@ -705,6 +3455,9 @@ async def service_tg_operator(cb: CallbackQuery, state: FSMContext):
 # =========================
 @dp.message(TicketStates.wait_client_message)
 async def client_message_for_ticket(message: Message, state: FSMContext):
+    batch = await collect_album(message)
+    if batch is None:
+        return
     lang = await get_lang(message.from_user.id)
     data = await state.get_data()
     service = data.get("preselected_service") or "Generale"
@@ -712,23 +3465,14 @@ async def client_message_for_ticket(message: Message, state: FSMContext):
     existing = await get_open_ticket_by_client(message.from_user.id)
     if existing:
         ticket_id = existing[0]
-        is_new = False
     else:
         ticket_id = await create_ticket(message.from_user.id, service)
-        is_new = True
 
-    msg_text = (message.text or "").strip()
-    await log_message(ticket_id, "client", msg_text)
-
-    client = await get_client(message.from_user.id)
-    phone = client[1] if client else ""
-    surname = client[2] if client else ""
-    name = client[3] if client else ""
+    await log_batch(ticket_id, "client", batch)
 
     if OPERATORS_GROUP_ID != 0:
-        txt = tr(lang, "ticket_text_new" if is_new else "ticket_text_msg",
-                 ticket=ticket_id, name=name, surname=surname, phone=phone, service=service, msg=msg_text)
-        await bot.send_message(OPERATORS_GROUP_ID, txt, reply_markup=kb_ticket_actions(lang, ticket_id))
+        # the card is posted (or edited) shortly; media can't live in it, so they follow as copies
+        ticket_cards.touch(ticket_id, media=batch if message.text is None else None)
     else:
         log.warning("OPERATORS_GROUP_ID not set. Can't notify operators.")
 
@@ -749,17 +3493,15 @@ async def ticket_claim(cb: CallbackQuery):
         await cb.answer(tr(lang, "only_operators"), show_alert=True)
         return
 
-    t = await get_ticket(ticket_id)
-    if not t:
+    res = await transition(ticket_id, "claim", cb.from_user.id)
+    if res.ok or (res.ticket and res.ticket[3] == "in_progress" and res.ticket[4] == cb.from_user.id):
+        await cb.answer(tr(lang, "taken_ok"))
+    elif res.reason == "not_found":
         await cb.answer(tr(lang, "ticket_not_found"), show_alert=True)
-        return
-
-    if t[4] is not None and t[4] != cb.from_user.id:
+    elif res.reason == "assigned_other":
         await cb.answer(tr(lang, "already_taken"), show_alert=True)
-        return
-
-    await assign_ticket(ticket_id, cb.from_user.id)
-    await cb.answer(tr(lang, "taken_ok"))
+    else:
+        await cb.answer(tr(lang, "ticket_wrong_state", ticket=ticket_id, status=res.ticket[3]), show_alert=True)
 
 @dp.callback_query(F.data.startswith("t:reply:"))
 async def ticket_reply(cb: CallbackQuery):
@@ -769,20 +3511,22 @@ async def ticket_reply(cb: CallbackQuery):
         await cb.answer(tr(lang, "only_operators"), show_alert=True)
         return
 
-    t = await get_ticket(ticket_id)
-    if not t:
-        await cb.answer(tr(lang, "ticket_not_found"), show_alert=True)
-        return
-
-    assigned = t[4]
-    if assigned is None:
-        await assign_ticket(ticket_id, cb.from_user.id)
-    elif assigned != cb.from_user.id:
-        await cb.answer(tr(lang, "assigned_other"), show_alert=True)
-        return
+    # claims an unassigned ticket; already ours and in progress is fine too
+    res = await transition(ticket_id, "claim", cb.from_user.id)
+    if not res.ok:
+        t = res.ticket
+        if res.reason == "not_found":
+            await cb.answer(tr(lang, "ticket_not_found"), show_alert=True)
+            return
+        if res.reason == "assigned_other":
+            await cb.answer(tr(lang, "assigned_other"), show_alert=True)
+            return
+        if t[3] != "in_progress":
+            await cb.answer(tr(lang, "ticket_wrong_state", ticket=ticket_id, status=t[3]), show_alert=True)
+            return
 
     ACTIVE_TICKET[cb.from_user.id] = ticket_id
-    await bot.send_message(cb.from_user.id, tr(lang, "active_chat_on", ticket=ticket_id))
+    outbox.send(cb.from_user.id, tr(lang, "active_chat_on", ticket=ticket_id))
     await cb.answer("OK")
 
 @dp.callback_query(F.data.startswith("t:close:"))
@@ -793,17 +3537,16 @@ async def ticket_close(cb: CallbackQuery):
         await cb.answer(tr(lang, "only_operators"), show_alert=True)
         return
 
-    t = await get_ticket(ticket_id)
-    if not t:
-        await cb.answer(tr(lang, "ticket_not_found"), show_alert=True)
-        return
-
-    assigned = t[4]
-    if assigned is not None and assigned != cb.from_user.id:
-        await cb.answer(tr(lang, "assigned_other"), show_alert=True)
+    res = await transition(ticket_id, "close", cb.from_user.id)
+    if not res.ok:
+        if res.reason == "not_found":
+            await cb.answer(tr(lang, "ticket_not_found"), show_alert=True)
+        elif res.reason == "assigned_other":
+            await cb.answer(tr(lang, "assigned_other"), show_alert=True)
+        else:
+            await cb.answer(tr(lang, "ticket_wrong_state", ticket=ticket_id, status=res.ticket[3]), show_alert=True)
         return
-
-    await set_ticket_status(ticket_id, "closed")
+    t = res.ticket
     await cb.answer("OK")
 
     # remove active chat for this operator if it points to this ticket
@@ -812,13 +3555,7 @@ async def ticket_close(cb: CallbackQuery):
 
     # notify client in their language
     client_lang = await get_lang(t[1])
-    try:
-        await bot.send_message(t[1], tr(client_lang, "ticket_closed"))
-    except Exception:
-        pass
-
-    if OPERATORS_GROUP_ID != 0:
-        await bot.send_message(OPERATORS_GROUP_ID, f"🔒 <b>{ticket_id}</b> closed.")
+    outbox.send(t[1], tr(client_lang, "ticket_closed"))
 
 
 # =========================
@@ -835,8 +3572,6 @@ async def stop_active_chat(message: Message):
     else:
         await message.answer(tr(lang, "no_active_chat"))
 
-from aiogram.enums import ChatType
-
 @dp.message(Command("ticket"))
 async def ticket_info(message: Message):
     if not is_admin(message.from_user.id):
@@ -848,54 +3583,15 @@ async def ticket_info(message: Message):
     t = await get_ticket(ticket_id)
     await message.answer(f"TICKET: {t}")
 
-    # client in private: continue conversation if ticket open, else show menu
-    lang = await get_lang(message.from_user.id)
-    open_ticket = await get_open_ticket_by_client(message.from_user.id)
-    if not open_ticket:
-        await message.answer(tr(lang, "select_service"), reply_markup=kb_main_menu(lang))
-        return
-
-    ticket_id = open_ticket[0]
-    text = (message.text or "").strip()
-    if not text:
-        return
-
-    await log_message(ticket_id, "client", text)
-
-    client = await get_client(message.from_user.id)
-    phone = client[1] if client else ""
-    surname = client[2] if client else ""
-    name = client[3] if client else ""
-
-    t = await get_ticket(ticket_id)
-    assigned_operator_id = t[4] if t else None
-
-    # notify assigned operator in private (auto-activate)
-    if assigned_operator_id:
-        try:
-            await bot.send_message(
-                assigned_operator_id,
-                tr(lang, "ticket_text_msg", ticket=ticket_id, name=name, surname=surname, phone=phone, msg=text)
-            )
-            ACTIVE_TICKET[assigned_operator_id] = ticket_id
-        except Exception:
-            pass
-
-    # also notify operators group (so nothing is lost)
-    # if OPERATORS_GROUP_ID != 0:
-    #     await bot.send_message(
-    #         OPERATORS_GROUP_ID,
-    #         tr(lang, "ticket_text_msg", ticket=ticket_id, name=name, surname=surname, phone=phone, msg=text),
-    #         reply_markup=kb_ticket_actions(lang, ticket_id)
-    #     )
-
-
 
 # ---------- PRIVATE: ADMIN ----------
 @dp.message(F.chat.type == ChatType.PRIVATE, F.from_user.id.in_(ADMIN_IDS))
 async def private_admin_router(message: Message):
     if is_command_text(message.text):
         return
+    batch = await collect_album(message)
+    if batch is None:
+        return
 
     lang = await get_lang(message.from_user.id)
     ticket_id = ACTIVE_TICKET.get(message.from_user.id)
@@ -911,18 +3607,27 @@ async def private_admin_router(message: Message):
         return
 
     text = (message.text or "").strip()
-    if not text:
+    if message.text is not None and not text:
         return
 
-    await log_message(ticket_id, "operator", text)
+    await log_batch(ticket_id, "operator", batch)
+    ticket_cards.touch(ticket_id)
+    ACTIVE_TICKET.touch(message.from_user.id)
 
     client_tg_id = t[1]
-    try:
-        await bot.send_message(client_tg_id, f"{text}")
-        await message.answer(tr(lang, "sent_ok"))
-    except Exception as e:
-        log.exception("Failed to send message to client %s for ticket %s", client_tg_id, ticket_id)
-        await message.answer(f"❌ Не вдалося надіслати клієнту.\nПомилка: {type(e).__name__}: {e}")
+    operator_id = message.from_user.id
+
+    def report_failure(fut: asyncio.Future):
+        # delivery is async now: tell the operator if the outbox gave up on it
+        if fut.cancelled() or fut.exception() is None:
+            return
+        e = fut.exception()
+        log.error("Failed to send message to client %s for ticket %s: %r", client_tg_id, ticket_id, e)
+        outbox.send(operator_id, f"❌ Не вдалося надіслати клієнту ({ticket_id}).\nПомилка: {type(e).__name__}: {html.escape(str(e))}")
+
+    sent = relay(batch, client_tg_id) if message.text is None else outbox.send(client_tg_id, text)
+    sent.add_done_callback(report_failure)
+    await message.answer(tr(lang, "sent_ok"))
 
 
 # ---------- PRIVATE: CLIENT ----------
@@ -942,35 +3647,12 @@ async def private_client_router(message: Message, state: FSMContext):
         await message.answer(tr(lang, "select_service"), reply_markup=kb_main_menu(lang))
         return
 
-    ticket_id = open_ticket[0]
-    text = (message.text or "").strip()
-    if not text:
+    if message.text is not None and not message.text.strip():
         return
 
-    await log_message(ticket_id, "client", text)
-
-    client = await get_client(message.from_user.id)
-    phone = client[1] if client else ""
-    surname = client[2] if client else ""
-    name = client[3] if client else ""
-
-    # беремо актуального оператора (якщо вже призначений)
-    t = await get_ticket(ticket_id)
-    assigned_operator_id = t[4] if t else None
-
-    msg_to_ops = tr(lang, "ticket_text_msg", ticket=ticket_id, name=name, surname=surname, phone=phone, msg=text)
-
-    # ✅ 1) завжди в групу операторів (щоб не губилось)
-    # if OPERATORS_GROUP_ID != 0:
-    #     await bot.send_message(OPERATORS_GROUP_ID, msg_to_ops, reply_markup=kb_ticket_actions(lang, ticket_id))
-
-    # ✅ 2) якщо є assigned оператор — ще й в приват оператору + автоактивація чату
-    if assigned_operator_id:
-        try:
-            await bot.send_message(assigned_operator_id, msg_to_ops)
-            ACTIVE_TICKET[assigned_operator_id] = ticket_id
-        except Exception:
-            pass
+    # logged and forwarded to the assigned operator by the digest, together with
+    # whatever else the client types in the next CLIENT_DIGEST_MS (albums included)
+    client_digest.add(open_ticket.ticket_id, message.from_user.id, message)
 
 # =========================
 # FALLBACK: non-private chats (groups etc.)
@@ -988,13 +3670,104 @@ async def non_private_fallback(message: Message):
 # =========================
 # MAIN
 # =========================
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise web.HTTPUnauthorized()
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+async def run_polling():
+    # a webhook left over from webhook mode would make getUpdates fail
+    await bot.delete_webhook()
+    runner = None
+    if METRICS_PORT:
+        app = web.Application()
+        app.router.add_get(METRICS_PATH, metrics_endpoint)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBAPP_HOST, METRICS_PORT).start()
+        log.info("Metrics on %s:%s%s", WEBAPP_HOST, METRICS_PORT, METRICS_PATH)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get(METRICS_PATH, metrics_endpoint)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    log.info("Webhook server listening on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        log.info("Webhook registered: %s%s", WEBHOOK_BASE_URL, WEBHOOK_PATH)
+    else:
+        log.warning("WEBHOOK_BASE_URL not set: webhook not registered with Telegram (local mode).")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        log.info("Webhook server stopping...")
+        # runs dp shutdown hooks, waits for in-flight requests and closes the bot session
+        await runner.cleanup()
+
 async def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN missing in .env")
-
-    await init_db()
-    log.info("Bot starting... ADMIN_IDS=%s OPERATORS_GROUP_ID=%s", ADMIN_IDS, OPERATORS_GROUP_ID)
-    await dp.start_polling(bot)
+    if BOT_MODE not in ("polling", "webhook"):
+        raise RuntimeError(f"BOT_MODE must be 'polling' or 'webhook', got {BOT_MODE!r}")
+    if BOT_MODE == "webhook" and WEBHOOK_BASE_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET missing: required when WEBHOOK_BASE_URL registers a public webhook")
+    if WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_SECRET may only contain A-Z, a-z, 0-9, _ and - (max 256 chars)")
+
+    services.load()
+    await db_pool.open()
+    try:
+        await init_db()
+        await open_tickets.load()
+        await ACTIVE_TICKET.load()
+        await fsm_storage.start()
+        await outbox.start()
+        await services.start()
+        await lifecycle.start()
+        log.info("Bot starting (%s)... ADMIN_IDS=%s OPERATORS_GROUP_ID=%s", BOT_MODE, ADMIN_IDS, OPERATORS_GROUP_ID)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await services.close()
+        await lifecycle.close()
+        await client_digest.close()
+        await ticket_cards.close()
+        await outbox.close()
+        await fsm_storage.close()
+        await db_pool.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,18 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def db_pool(tmp_path, monkeypatch):
+    """A fresh pool per test: its queues and locks bind to the event loop of that test's asyncio.run."""
+    pool = bot.DBPool(str(tmp_path / "bot.db"), readers=3)
+    monkeypatch.setattr(bot, "db_pool", pool)
+    return pool
@@ -0,0 +1,38 @@
+import asyncio
+
+import bot
+
+
+def test_cold_read_does_not_overwrite_concurrent_upsert(db_pool, monkeypatch):
+    """get_client misses, an upsert lands while its SELECT is in flight: the cache must keep the upserted row."""
+    monkeypatch.setattr(bot, "client_cache", bot.TTLCache(100, 600))
+
+    async def scenario():
+        await db_pool.open()
+        try:
+            await bot.init_db()
+            await bot.upsert_client(7, "39333", "Rossi", "Mario", "it")
+            bot.client_cache.clear()
+
+            fetchone = db_pool.fetchone
+            read_done = asyncio.Event()
+
+            async def slow_read(*args, **kwargs):
+                row = await fetchone(*args, **kwargs)
+                read_done.set()
+                await asyncio.sleep(0.05)
+                return row
+
+            monkeypatch.setattr(db_pool, "fetchone", slow_read)
+
+            async def change_lang():
+                await read_done.wait()
+                await bot.upsert_client(7, None, None, None, "uk")
+
+            await asyncio.gather(bot.get_client(7), change_lang())
+            monkeypatch.setattr(db_pool, "fetchone", fetchone)
+            return await bot.get_lang(7)
+        finally:
+            await db_pool.close()
+
+    assert asyncio.run(scenario()) == "uk"
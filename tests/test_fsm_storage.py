@@ -0,0 +1,47 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+
+
+def test_cold_cache_concurrent_reads_keep_the_write(tmp_path):
+    """Two updates of one key miss the cache together: the slower read must not overwrite the other's set_state."""
+
+    async def scenario():
+        bot.db_pool.path = str(tmp_path / "fsm.db")
+        await bot.db_pool.open()
+        try:
+            await bot.init_db()
+            storage = bot.SQLiteStorage(bot.db_pool)
+            key = StorageKey(bot_id=1, chat_id=7, user_id=7)
+
+            fetchone = storage.pool.fetchone
+            calls = 0
+
+            async def slow_second_read(*args, **kwargs):
+                nonlocal calls
+                calls += 1
+                delay = 0.05 if calls == 2 else 0
+                row = await fetchone(*args, **kwargs)
+                await asyncio.sleep(delay)
+                return row
+
+            storage.pool = type("Pool", (), {"fetchone": staticmethod(slow_second_read)})()
+
+            async def first():
+                await storage.get_state(key)
+                await storage.set_state(key, "TicketStates:wait_client_message")
+
+            await asyncio.gather(first(), storage.get_state(key))
+            storage.pool = bot.db_pool
+            return await storage.get_state(key)
+        finally:
+            await bot.db_pool.close()
+
+    assert asyncio.run(scenario()) == "TicketStates:wait_client_message"
@@ -0,0 +1,67 @@
+import asyncio
+import html
+import re
+
+import bot
+
+LIMIT = 4096
+
+
+async def rows_of(texts):
+    for i, text in enumerate(texts):
+        yield i, "client", text, "2026-10-17T10:00:00+00:00", None, None
+
+
+def chunks(texts, limit=LIMIT):
+    async def collect():
+        return [c async for c in bot.history_chunks(rows_of(texts), limit)]
+
+    return asyncio.run(collect())
+
+
+def visible(chunk: str) -> str:
+    return html.unescape(re.sub(r"</?b>", "", chunk))
+
+
+def pieces(chunk: str) -> list[str]:
+    return [html.unescape(line.split("</b>", 1)[1]) for line in chunk.split("\n")]
+
+
+def test_utf16_len_counts_astral_chars_twice():
+    assert bot.utf16_len("ab") == 2
+    assert bot.utf16_len("é€") == 2
+    assert bot.utf16_len("😀") == 2
+    assert bot.utf16_len("👩‍💻") == 5  # 👩 ZWJ 💻
+
+
+def test_split_never_breaks_a_surrogate_pair():
+    # odd room: the pair that would straddle the edge moves to the next piece
+    parts = list(bot._split_utf16("a" + "😀" * 10, 6))
+    assert parts == ["a😀😀", "😀😀😀", "😀😀😀", "😀😀"]
+    assert all(bot.utf16_len(p) <= 6 for p in parts)
+
+
+def test_emoji_message_splits_at_the_4096_unit_boundary():
+    # one message well past the limit, with astral chars on every odd/even alignment
+    text = "x" + "😀" * 3000 + "y" + "🇮🇹" * 1000 + "é" * 500
+    out = chunks([text])
+    assert len(out) > 1
+    assert all(bot.utf16_len(visible(c)) <= LIMIT for c in out)
+    assert "".join(p for c in out for p in pieces(c)) == text
+    for c in out:
+        c.encode("utf-16-le")  # raises on a lone surrogate
+    # chunks are filled up to the limit, not split early
+    assert bot.utf16_len(visible(out[0])) >= LIMIT - 1
+
+
+def test_messages_that_fit_share_a_chunk():
+    out = chunks(["ciao 👋", "привіт 🇺🇦"])
+    assert len(out) == 1
+    assert pieces(out[0]) == ["ciao 👋", "привіт 🇺🇦"]
+
+
+def test_chunk_counts_escapes_as_visible_text():
+    # "<" costs 1 unit on screen but 4 chars escaped: the limit is on what Telegram counts
+    out = chunks(["<" * 5000])
+    assert all(bot.utf16_len(visible(c)) <= LIMIT for c in out)
+    assert "".join(p for c in out for p in pieces(c)) == "<" * 5000
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import EditMessageText
+
+import bot
+
+
+class FailingBot:
+    def __init__(self, description: str):
+        self.description = description
+
+    async def __call__(self, method):
+        raise TelegramBadRequest(method=method, message=f"Bad Request: {self.description}")
+
+
+def edit(outbox, expected=()):
+    return outbox.call(-100, EditMessageText(chat_id=-100, message_id=5, text="card"), expected=expected)
+
+
+def run_outbox(description, expected):
+    async def scenario():
+        outbox = bot.Outbox(FailingBot(description), workers=1)
+        await outbox.start()
+        try:
+            with pytest.raises(TelegramBadRequest):
+                await edit(outbox, expected)
+        finally:
+            await outbox.close()
+        return outbox
+
+    return asyncio.run(scenario())
+
+
+def test_expected_bad_request_fails_the_call_without_a_dead_letter():
+    outbox = run_outbox("message to edit not found", ("message to edit not found",))
+    assert not outbox.dead_letters
+    assert outbox.stats()["failed"] == 0
+
+
+def test_unexpected_bad_request_is_a_dead_letter():
+    outbox = run_outbox("chat not found", ("message to edit not found",))
+    assert len(outbox.dead_letters) == 1
+    assert outbox.stats()["failed"] == 1
@@ -0,0 +1,154 @@
+import asyncio
+import re
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+ADMIN, OTHER_ADMIN = 1, 2
+
+
+@pytest.fixture(autouse=True)
+def admins(monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_IDS", {ADMIN, OTHER_ADMIN})
+    monkeypatch.setattr(bot, "_browsers", bot.TTLCache(maxsize=100, ttl=3600))
+
+
+class FakeMessage:
+    def __init__(self):
+        self.text = None
+        self.markup = None
+
+    async def answer(self, text, reply_markup=None):
+        self.text, self.markup = text, reply_markup
+
+    async def edit_text(self, text, reply_markup=None):
+        self.text, self.markup = text, reply_markup
+
+
+class FakeCallback:
+    def __init__(self, user_id, data, message):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = message
+        self.alert = None
+
+    async def answer(self, text=None, show_alert=False):
+        self.alert = text if show_alert else None
+
+
+def ids(message: FakeMessage) -> list[str]:
+    return re.findall(r"DD-\d{4}-\d{6}", message.text)
+
+
+def buttons(message: FakeMessage) -> dict[str, str]:
+    if message.markup is None:
+        return {}
+    return {b.text: b.callback_data for row in message.markup.inline_keyboard for b in row}
+
+
+async def seed(pool, stamps: list[str]):
+    await pool.open()
+    await bot.init_db()
+    async with pool.write() as db:
+        for i, ts in enumerate(stamps, 1):
+            await db.execute(
+                "INSERT INTO tickets (ticket_id, client_tg_id, service, status, created_at, updated_at) "
+                "VALUES (?, ?, 'ISEE', 'closed', ?, ?)",
+                (bot.format_ticket_id(2026, i), i, ts, ts),
+            )
+
+
+async def click(user_id, message, direction):
+    view_id = buttons(message)[{"n": "➡️", "p": "⬅️"}[direction]].split(":")[2]
+    cb = FakeCallback(user_id, f"adm:pg:{view_id}:{direction}", message)
+    await bot.admin_page(cb)
+    return cb
+
+
+def run(pool, scenario):
+    async def wrapper():
+        try:
+            return await scenario()
+        finally:
+            await pool.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_pages_cover_ties_without_gaps_or_repeats(db_pool):
+    # 7 tickets on two timestamps: the page boundaries fall inside runs of equal updated_at
+    stamps = ["2026-01-01T00:00:00+00:00"] * 4 + ["2026-01-02T00:00:00+00:00"] * 3
+
+    async def scenario():
+        await seed(db_pool, stamps)
+        msg = FakeMessage()
+        await bot.open_browser(msg, ADMIN, "it", bot.TicketFilter("closed"), page_size=3)
+        pages = [ids(msg)]
+        while "➡️" in buttons(msg):
+            await click(ADMIN, msg, "n")
+            pages.append(ids(msg))
+        return pages, buttons(msg)
+
+    pages, last_buttons = run(db_pool, scenario)
+    expected = [bot.format_ticket_id(2026, i) for i in (7, 6, 5, 4, 3, 2, 1)]
+    assert pages == [expected[0:3], expected[3:6], expected[6:7]]
+    assert list(last_buttons) == ["⬅️"]
+
+
+def test_full_last_page_has_no_next(db_pool):
+    async def scenario():
+        await seed(db_pool, [f"2026-01-0{i}T00:00:00+00:00" for i in range(1, 7)])
+        msg = FakeMessage()
+        await bot.open_browser(msg, ADMIN, "it", bot.TicketFilter("closed"), page_size=3)
+        first = buttons(msg)
+        await click(ADMIN, msg, "n")
+        return first, ids(msg), buttons(msg)
+
+    first, second_ids, second = run(db_pool, scenario)
+    assert list(first) == ["➡️"]
+    assert len(second_ids) == 3
+    assert list(second) == ["⬅️"]
+
+
+def test_stepping_back_shows_the_same_page(db_pool):
+    async def scenario():
+        await seed(db_pool, ["2026-01-01T00:00:00+00:00"] * 8)
+        msg = FakeMessage()
+        await bot.open_browser(msg, ADMIN, "it", bot.TicketFilter("closed"), page_size=3)
+        first = ids(msg)
+        await click(ADMIN, msg, "n")
+        second = ids(msg)
+        await click(ADMIN, msg, "n")
+        await click(ADMIN, msg, "p")
+        again_second = ids(msg)
+        await click(ADMIN, msg, "p")
+        return first, second, again_second, ids(msg), buttons(msg)
+
+    first, second, again_second, again_first, first_buttons = run(db_pool, scenario)
+    assert again_second == second
+    assert again_first == first
+    assert list(first_buttons) == ["➡️"]
+
+
+def test_view_rejects_other_users_and_unknown_ids(db_pool):
+    async def scenario():
+        await seed(db_pool, ["2026-01-01T00:00:00+00:00"] * 5)
+        msg = FakeMessage()
+        await bot.open_browser(msg, ADMIN, "it", bot.TicketFilter("closed"), page_size=2)
+        first = ids(msg)
+        foreign = await click(OTHER_ADMIN, msg, "n")
+        after_foreign = ids(msg)
+        stale = FakeCallback(ADMIN, "adm:pg:1:n", msg)  # a counter-style id from before a restart
+        await bot.admin_page(stale)
+        return first, foreign.alert, after_foreign, stale.alert
+
+    first, foreign_alert, after_foreign, stale_alert = run(db_pool, scenario)
+    assert foreign_alert == bot.tr("it", "page_not_yours")
+    assert after_foreign == first
+    assert stale_alert == bot.tr("it", "page_expired")
+
+
+def test_view_ids_are_not_sequential():
+    assert len({bot.new_browser_id() for _ in range(100)}) == 100
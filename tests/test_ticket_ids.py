@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, UTC
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+
+def test_format_rejects_sequence_past_six_digits():
+    assert bot.format_ticket_id(2026, bot.TICKET_SEQ_MAX) == "DD-2026-999999"
+    with pytest.raises(ValueError):
+        bot.format_ticket_id(2026, bot.TICKET_SEQ_MAX + 1)
+
+
+def test_allocation_stops_at_the_cap(tmp_path):
+    """The last six-digit id is issued; the next allocation fails and leaves counter and table untouched."""
+
+    async def scenario():
+        bot.db_pool.path = str(tmp_path / "ids.db")
+        await bot.db_pool.open()
+        try:
+            await bot.init_db()
+            year = datetime.now(UTC).year
+            await bot.db_pool.execute(
+                "INSERT INTO ticket_seq (year, last) VALUES (?, ?) ON CONFLICT(year) DO UPDATE SET last = excluded.last",
+                (year, bot.TICKET_SEQ_MAX - 1),
+            )
+            last = await bot.create_ticket(1, "ISEE")
+            with pytest.raises(RuntimeError, match="exhausted"):
+                await bot.create_ticket(2, "ISEE")
+            seq = await bot.db_pool.fetchone("SELECT last FROM ticket_seq WHERE year=?", (year,))
+            count = await bot.db_pool.fetchone("SELECT COUNT(*) FROM tickets")
+            return year, last, seq[0], count[0]
+        finally:
+            await bot.db_pool.close()
+
+    year, last, seq, count = asyncio.run(scenario())
+    assert last == f"DD-{year}-999999"
+    assert seq == bot.TICKET_SEQ_MAX
+    assert count == 1
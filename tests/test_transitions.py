@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(bot, "open_tickets", bot.OpenTicketIndex())
+
+
+def run(pool, scenario):
+    async def wrapper():
+        await pool.open()
+        try:
+            await bot.init_db()
+            return await scenario()
+        finally:
+            await pool.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_claim_racing_claim_has_one_winner(db_pool):
+    async def scenario():
+        tid = await bot.create_ticket(7, "ISEE")
+        results = await asyncio.gather(*(bot.transition(tid, "claim", op) for op in (101, 102)))
+        return results, await bot.get_ticket(tid)
+
+    results, ticket = run(db_pool, scenario)
+    winners = [r for r in results if r.ok]
+    losers = [r for r in results if not r.ok]
+    assert len(winners) == 1 and len(losers) == 1
+    assert ticket[3] == "in_progress" and ticket[4] == winners[0].ticket[4]
+    assert losers[0].reason == "assigned_other"
+    assert losers[0].ticket[4] == ticket[4]
+
+
+def test_close_of_closed_ticket_is_refused(db_pool):
+    async def scenario():
+        tid = await bot.create_ticket(7, "ISEE")
+        first = await bot.transition(tid, "close", None)
+        second = await bot.transition(tid, "close", None)
+        missing = await bot.transition("DD-2026-999999", "close", None)
+        return first, second, missing
+
+    first, second, missing = run(db_pool, scenario)
+    assert first.ok and first.ticket[3] == "closed"
+    assert not second.ok and second.reason == "state"
+    assert not missing.ok and missing.reason == "not_found"
+
+
+def test_reopen_blocked_while_client_has_another_open_ticket(db_pool):
+    async def scenario():
+        old = await bot.create_ticket(7, "ISEE")
+        await bot.transition(old, "close", None)
+        new = await bot.create_ticket(7, "730")
+        blocked = await bot.transition(old, "reopen", None)
+        await bot.transition(new, "close", None)
+        allowed = await bot.transition(old, "reopen", None)
+        return old, blocked, allowed, bot.open_tickets.get(7)
+
+    old, blocked, allowed, indexed = run(db_pool, scenario)
+    assert not blocked.ok and blocked.reason == "client_has_open"
+    assert blocked.ticket[3] == "closed"
+    assert allowed.ok and allowed.ticket[3] == "new"
+    assert indexed.ticket_id == old
+
+
+def test_transitions_write_ticket_events(db_pool):
+    async def scenario():
+        tid = await bot.create_ticket(7, "ISEE")
+        await bot.transition(tid, "claim", 101)
+        await bot.transition(tid, "claim", 102)  # refused: no event
+        await bot.transition(tid, "close", 101)
+        await bot.transition(tid, "reopen", 101)
+        return await bot.db_pool.fetchall(
+            "SELECT from_status, to_status, operator_id, actor_id FROM ticket_events WHERE ticket_id=? ORDER BY id",
+            (tid,),
+        )
+
+    rows = [tuple(r) for r in run(db_pool, scenario)]
+    assert rows == [
+        (None, "new", None, 7),
+        ("new", "in_progress", 101, 101),
+        ("in_progress", "closed", 101, 101),
+        ("closed", "in_progress", 101, 101),
+    ]